@@ -26,6 +26,7 @@ settings.configure(
             'NAME': 'pb_workflow_engine'
         }
     },
+    BROKER_URL = 'memory://',
     CELERY_RESULT_BACKEND = 'django-db',
     CELERY_CACHE_BACKEND = 'django-cache',
     INSTALLED_APPS = (
@@ -1,5 +1,13 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 class PbDjangoWorkflowConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'pb_djworkflow'
+
+    def ready(self):
+        from . import receivers
+        from .tracing import TRACER, JsonFileExporter
+        
+        if getattr(settings, 'PB_WORKFLOW_TRACE_FILE', None):
+            TRACER.exporter = JsonFileExporter(settings.PB_WORKFLOW_TRACE_FILE)
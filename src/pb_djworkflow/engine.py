@@ -1,15 +1,68 @@
+import time, uuid, threading
+from datetime import timedelta
+from itertools import islice
+from contextlib import contextmanager
 from typing  import Type
 from collections import namedtuple
 from django.db import transaction
+from django.utils import timezone
+from django.db.models import CharField, Count, F, Min, Q, Value
+from django.db.models.functions import Cast, Concat, Mod
+from celery import group
 
-from . import exceptions, models
+from . import exceptions, models, metrics, inbox
+from .notify import NOTIFIER
+from .metrics import METRICS
+from .tracing import TRACER
+from .status import STALL, EXPIRED, FAILED, PENDING
+from .routing import RateLimiter
 
 TaskSpawn = namedtuple('TaskSpawn', ['task', 'job'])
 FlowSpawn = namedtuple('FlowSpawn', ['context', 'process', 'start_spawn'])
+SubmitResult = namedtuple('SubmitResult', ['task', 'activation', 'error'])
+
+class IdentityMap:
+    """
+        The processes and the contexts loaded within a chain of activations,
+        by process id.
+    """
+    def __init__(self):
+        self.processes = {}
+        self.contexts = {}
+
+    def process(self, task):
+        process = self.processes.get(task.process_id)
+
+        if process is None:
+            process = self.processes[task.process_id] = task.process
+        else:
+            task.process = process
+        
+        return process
+
+    def context(self, flow, process):
+        context = self.contexts.get(process.id)
+
+        if context is None:
+            context = self.contexts[process.id] = flow.context(process)
+        
+        context.process = process
+        return context
+
+    def add(self, context):
+        self.processes.setdefault(context.process_id, context.process)
+        self.contexts[context.process_id] = context
+        return context
+
+    def evict(self, process):
+        self.processes.pop(process.id, None)
+        self.contexts.pop(process.id, None)
 
 class Engine:
     def __init__(self):
         self.flows = {}
+        self.local = threading.local()
+        self.limiter = RateLimiter()
 
     def register(self, cls):
         self.flows[cls.get_name()] = cls
@@ -29,6 +82,27 @@ class Engine:
         """
         flow = self.flow(process.flow_class)
         return flow.context(process)        
+
+    def contexts(self, processes):
+        """
+            Returns the contexts behind the processes, by process id, 
+            with one query per flow.
+        """
+        by_flow = {}
+        
+        for process in processes:
+            by_flow.setdefault(process.flow_class, {})[process.id] = process
+        
+        contexts = {}
+
+        for flow_class, by_id in by_flow.items():
+            flow = self.flow(flow_class)
+
+            for context in flow.context_class.objects.filter(process__in=list(by_id)):
+                context.process = by_id[context.process_id]
+                contexts[context.process_id] = context
+        
+        return contexts
     
     def spawn_flow(self, flow, **kwargs):
         """
@@ -41,95 +115,590 @@ class Engine:
 
         if "user" in kwargs:
             process.created_by = kwargs['user']
-            
-        process.save()
 
-        context = flow.context_factory(
-            context_class=flow.context_class, 
-            process=process, 
-            **kwargs
-        )
+        if "supratask" in kwargs:
+            process.supratask = kwargs['supratask']
         
-        task_spawn = self.spawn_task(
-            "start", 
-            process, 
-            **kwargs
-        )
+        with transaction.atomic():
+            process.save()
+
+            context = flow.context_factory(
+                context_class=flow.context_class, 
+                process=process, 
+                **kwargs
+            )
+            
+            task_spawn = self.spawn_task(
+                "start", 
+                process, 
+                **kwargs
+            )
         
         return FlowSpawn(context=context, process=process, start_spawn=task_spawn)
-            
-    def spawn_task(self, step, process, previous=None, **kwargs):
+
+    def spawn_flows(self, flow, kwargs_list, chunk_size=500):
         """
-            Create a task
+            Spawn a workflow for each kwargs, chunk by chunk.
+
+            Processes, contexts and start tasks are bulk created, and the start 
+            activations are dispatched as one group per chunk. An invalid 
+            context form raises InvalidForm, the previous chunks are kept.
+
+            Returns: a list of (context, process, start_task)
         """
         from .tasks import activate
-        
+
+        flow = self.flow(flow)
+        kwargs_list = iter(kwargs_list)
+        spawns = []
+
+        while True:
+            chunk = list(islice(kwargs_list, chunk_size))
+
+            if not chunk:
+                return spawns
+
+            # The factories without build_many create their contexts one by one.
+            build_many = getattr(flow.context_factory, 'build_many', None)
+            contexts = None if build_many is None else build_many(flow.context_class, chunk)
+            processes = [
+                models.Process(flow_class=flow.get_name(), created_by=kwargs.get('user'), supratask=kwargs.get('supratask')) 
+                for kwargs in chunk
+            ]
+
+            with transaction.atomic():
+                models.Process.objects.bulk_create(processes)
+
+                if contexts is None:
+                    contexts = [
+                        flow.context_factory(context_class=flow.context_class, process=process, **kwargs)
+                        for process, kwargs in zip(processes, chunk)
+                    ]
+                
+                else:
+                    for context, process in zip(contexts, processes):
+                        context.process = process
+                    
+                    flow.context_class.objects.bulk_create(contexts)
+
+                tasks = [
+                    self.reserve_job(self.new_task("start", process, **kwargs)) 
+                    for process, kwargs in zip(processes, chunk)
+                ]
+
+                models.Task.objects.bulk_create(tasks)
+                self.dispatch(*tasks)
+            
+            spawns.extend(
+                FlowSpawn(
+                    context=context, 
+                    process=process, 
+                    start_spawn=TaskSpawn(task=task, job=activate.AsyncResult(task.current_job))
+                )
+                for context, process, task in zip(contexts, processes, tasks)
+            )
+    
+    def new_task(self, step, process, previous=None, **kwargs):
+        """
+            Build an unsaved task
+        """
         flow = self.flow(process.flow_class)
-        node = flow.node(step)
+
+        if step not in flow.graph.ids:
+            raise exceptions.InvalidFlow(flow, f'missing step "{step}"')
         
-        task = models.Task(process=process, step=step)
+        task = models.Task(process=process, step=step, previous=previous)
         
         if "user" in kwargs:
             task.assigned_to_user = kwargs['user']
-            del kwargs['user']
+        
+        return task
+
+    def runs_inline(self, task):
+        """
+            Returns True if the task is activated in the worker which spawned it.
+        """
+        return self.flow(task.process.flow_class).graph.runs_inline(task.step)
+
+    def route(self, flow_class, step):
+        """
+            Returns the routing of the activations of a step, see routing.Route
+        """
+        return self.flow(flow_class).graph.route(step)
+
+    def throttle(self, task):
+        """
+            Wait for the rate limit of the node of the task, if any.
+        """
+        flow_class = task.process.flow_class
+        route = self.route(flow_class, task.step)
+
+        if route.rate_limit:
+            self.limiter.wait((flow_class, task.step), route.rate_limit)
+
+    def backlog(self):
+        """
+            Returns the dispatched activations not started yet, by queue, 
+            as {queue: {'count': count, 'oldest': seconds}}.
+
+            Aggregated in SQL by flow and step, and by partition for the 
+            partitioned routes.
+        """
+        from .tasks import activate
+
+        default = activate.app.conf.task_default_queue
+        now = timezone.now()
+        pending = models.Task.objects.filter(status__in=PENDING, dispatched_at__isnull=False)
+        backlog = {}
+
+        for flow_class, step, count, oldest in pending\
+            .values_list('process__flow_class', 'step')\
+            .annotate(count=Count('id'), oldest=Min('dispatched_at'))\
+            .order_by():
+            
+            route = self.route(flow_class, step)
+            groups = [(0, count, oldest)]
+
+            if route.partitions:
+                # The partition of a process, as in Route.queue_of
+                groups = pending\
+                    .filter(process__flow_class=flow_class, step=step)\
+                    .annotate(partition=Mod('process_id', Value(route.partitions)))\
+                    .values_list('partition')\
+                    .annotate(count=Count('id'), oldest=Min('dispatched_at'))\
+                    .order_by()
+            
+            for partition, count, oldest in groups:
+                stats = backlog.setdefault(route.queue_of(int(partition), default), {'count': 0, 'oldest': 0})
+                stats['count'] += count
+                stats['oldest'] = max(stats['oldest'], (now - oldest).total_seconds())
+        
+        return backlog
+
+    def reserve_job(self, task):
+        """
+            Reserve the activation job id, so the task is written once.
+        """
+        task.current_job = str(uuid.uuid4())
+        task.dispatched_at = timezone.now()
+        return task
+
+    def dispatch(self, *tasks):
+        """
+            Schedule the activation of the tasks as a single group, 
+            once the current transaction is committed.
+        """
+        from .tasks import activate
+
+        if not tasks:
+            return
+
+        if TRACER.enabled:
+            # Propagated in the headers, so a process reads as one trace.
+            for task in tasks:
+                task.traceparent = TRACER.traceparent(task)
+
+        default = activate.app.conf.task_default_queue
+
+        self.send(*[
+            activate.si(task.id).set(
+                task_id=task.current_job, 
+                **self.route(task.process.flow_class, task.step).options(task.process_id, default),
+                **_headers(task)
+            )
+            for task in tasks
+        ])
+
+    def reenter(self, *tasks):
+        """
+            Schedule the reentry of supratasks, whose subprocess closed or failed, 
+            once the current transaction is committed.
+        """
+        from .tasks import reenter
+
+        if TRACER.enabled:
+            for task in tasks:
+                task.traceparent = TRACER.traceparent(task)
+
+        default = reenter.app.conf.task_default_queue
+
+        self.send(*[
+            reenter.si(task.id).set(
+                **self.route(task.process.flow_class, task.step).options(task.process_id, default),
+                **_headers(task)
+            )
+            for task in tasks
+        ])
+
+    def send(self, *jobs):
+        """
+            Send the jobs as a single group once the current transaction 
+            is committed, or with the group of the current batch.
+        """
+        if not jobs:
+            return
+
+        batch = getattr(self.local, 'batch', None)
+
+        if batch is not None:
+            batch.extend(jobs)
+            return
+
+        transaction.on_commit(group(jobs).apply_async)
+
+    def fire_deadlines(self, limit=500):
+        """
+            Activate the stalled tasks whose deadline passed, the earliest first.
+
+            The due tasks are claimed with one range scan on the deadline index 
+            and one update, then dispatched as a single group, whatever the 
+            number of pending deadlines.
+
+            Returns: the number of fired tasks
+        """
+        with transaction.atomic():
+            due = list(
+                models.Task.objects
+                    .filter(status=STALL, deadline__lte=timezone.now())
+                    .order_by('deadline')
+                    .values_list('id', flat=True)[:limit]
+            )
+
+            return self.redispatch(due, Q(status=STALL), status=EXPIRED)
+
+    def sweep(self, older_than=timedelta(minutes=10), chunk_size=500, dry_run=False):
+        """
+            Redispatch the pending tasks whose activation was lost, 
+            not dispatched or dispatched before older_than, and not started 
+            by a worker since, see Engine.running.
+
+            The pending tasks are scanned by chunks on the pending index, 
+            the stuck ones of a chunk are dispatched again as a single group.
+
+            Returns: the stats of the sweep, as a dict
+        """
+        start = time.monotonic()
+        cutoff = timezone.now() - older_than
+        overdue = Q(dispatched_at__lte=cutoff) | Q(dispatched_at__isnull=True, created_at__lte=cutoff)
+        stuck = overdue & (Q(started_at__isnull=True) | Q(started_at__lte=cutoff))
+        stats = {'stuck': 0, 'running': 0, 'redispatched': 0}
+        last = 0
+
+        while True:
+            chunk = list(
+                models.Task.objects
+                    .filter(overdue, status__in=PENDING, id__gt=last)
+                    .order_by('id')
+                    .values_list('id', 'started_at')[:chunk_size]
+            )
+
+            if not chunk:
+                break
+
+            last = chunk[-1][0]
+            ids = [id for id, started_at in chunk if started_at is None or started_at <= cutoff]
             
-        task.previous = previous
-        task.save()
+            stats['stuck'] += len(ids)
+            stats['running'] += len(chunk) - len(ids)
+
+            if ids and not dry_run:
+                # Unless activated, or started, meanwhile
+                stats['redispatched'] += self.redispatch(ids, stuck & Q(status__in=PENDING))
         
-        job = activate.delay(task.id)
+        stats['seconds'] = time.monotonic() - start
+        stats['per_second'] = (stats['stuck'] + stats['running']) / stats['seconds'] if stats['seconds'] else 0
+        
+        return stats
+
+    def redispatch(self, ids, condition=Q(), **changes):
+        """
+            Reserve a new job for each task matching the condition, with one 
+            update, and dispatch them as a single group once committed.
+
+            Returns: the number of dispatched tasks
+        """
+        from .tasks import activate
+
+        if not ids:
+            return 0
+
+        token = str(uuid.uuid4())
+
+        with transaction.atomic():
+            # The job ids are reserved in SQL, a concurrent claim gets the others.
+            models.Task.objects.filter(condition, id__in=ids).update(
+                current_job=Concat(Value(f'{token}:'), Cast('id', CharField())),
+                dispatched_at=timezone.now(),
+                version=F('version') + 1,
+                **changes
+            )
+
+            claimed = list(
+                models.Task.objects
+                    .filter(id__in=ids, current_job__startswith=f'{token}:')
+                    .values_list('id', 'current_job', 'process__flow_class', 'step', 'process_id')
+            )
+
+            if 'status' in changes:
+                # No more stalled, out of the inbox of their assignees.
+                inbox.close(id for id, *_ in claimed)
+
+            default = activate.app.conf.task_default_queue
+
+            self.send(*[
+                activate.si(id).set(
+                    task_id=job, 
+                    **self.route(flow_class, step).options(process_id, default)
+                ) 
+                for id, job, flow_class, step, process_id in claimed
+            ])
         
-        task.current_job = job.task_id
-        task.save()
+        return len(claimed)
+
+    @contextmanager
+    def batch(self):
+        """
+            Collect the activations and the reentries dispatched within the block, 
+            they are sent as a single group.
+        """
+        if getattr(self.local, 'batch', None) is not None:
+            yield
+            return
         
-        job.forget()
+        self.local.batch = []
 
-        return TaskSpawn(task=task, job=job)
+        try:
+            yield
+        finally:
+            jobs, self.local.batch = self.local.batch, None
+        
+        self.send(*jobs)
 
-    def submit(self, task: models.Task, **kwargs):
-        from .nodes import node_activation
+    @contextmanager
+    def identities(self):
+        """
+            Share the loaded processes and contexts within the block.
+        """
+        if getattr(self.local, 'identities', None) is not None:
+            yield self.local.identities
+            return
         
+        self.local.identities = IdentityMap()
+
         try:
-            flow    = self.flow(task.process.flow_class)
-            context = flow.context(task.process)
-            node    = flow.node(task.step)
+            yield self.local.identities
+        finally:
+            self.local.identities = None
 
-            if "user" in kwargs:
-                task.done_by = kwargs['user']
+    def spawn_task(self, step, process, previous=None, **kwargs):
+        """
+            Create a task
+        """
+        from .tasks import activate
+        
+        task = self.reserve_job(
+            self.new_task(step, process, previous=previous, **kwargs)
+        )
 
-            with node_activation(task=task, engine=self, context=context) as activation:
-                node.submit(activation=activation, **kwargs)
-                return activation
+        with transaction.atomic():
+            task.save()
+            self.dispatch(task)
+
+        return TaskSpawn(task=task, job=activate.AsyncResult(task.current_job))
+
+    def submit(self, task: models.Task, **kwargs):
+        """
+            Submit a task, and drive it until it reaches a stable state.
+        """
+        if "user" in kwargs:
+            task.done_by = kwargs['user']
+
+        return self.run(task, submit=kwargs)
+
+    def submit_many(self, tasks, form_kwargs_per_task, batch_size=100, **kwargs):
+        """
+            Submit many tasks at once.
+
+            The tasks, their processes and their contexts are loaded beforehand,
+            and every form is validated before writing. The accepted submissions
+            are written by batches, with one transaction and one dispatched 
+            group per batch.
+
+            The tasks of a process already submitted are submitted in a next 
+            pass, against its context as written by the previous one.
+
+            Returns: a list of (task, activation, error), a rejected submission
+            has either a TaskNotStall or an InvalidForm error, a missing task 
+            a Task.DoesNotExist error and its id as task.
+        """
+        ids = [models.Task._meta.pk.to_python(getattr(task, 'id', task)) for task in tasks]
+        form_kwargs_per_task = list(form_kwargs_per_task)
+
+        if len(ids) != len(form_kwargs_per_task):
+            raise ValueError(f'{len(ids)} tasks, but {len(form_kwargs_per_task)} form kwargs')
         
-        except exceptions.TaskNotStall as e:
-            raise e
+        results = [None] * len(ids)
+        pending = list(range(len(ids)))
+
+        while pending:
+            loaded = models.Task.objects.select_related('process').in_bulk({ids[index] for index in pending})
+            contexts = self.contexts([task.process for task in loaded.values()])
+            
+            accepted, deferred, submitted = [], [], set()
+
+            for index in pending:
+                task = loaded.get(ids[index])
+
+                if task is None:
+                    results[index] = SubmitResult(task=ids[index], activation=None, error=models.Task.DoesNotExist(f'Task {ids[index]} does not exist'))
+                    continue
+
+                # A form is validated against its own context, once the previous submission is written.
+                if task.process_id in submitted:
+                    deferred.append(index)
+                    continue
+                
+                submitted.add(task.process_id)
+                flow = self.flow(task.process.flow_class)
+                context = contexts[task.process_id]
+
+                if "user" in kwargs:
+                    task.done_by = kwargs['user']
+                
+                try:
+                    form = flow.node(task.step).validate(task, context, form_kwargs=form_kwargs_per_task[index])
+                    accepted.append((index, task, context, form))
+                
+                except (exceptions.TaskNotStall, exceptions.InvalidForm) as e:
+                    results[index] = SubmitResult(task=task, activation=None, error=e)
+
+            for start in range(0, len(accepted), batch_size):
+                with transaction.atomic(), self.batch(), self.identities():
+                    for index, task, context, form in accepted[start:start + batch_size]:
+                        try:
+                            activation = self.activate_node(task, context=context, submit={'form': form})
+                        except Exception as e:
+                            results[index] = SubmitResult(task=task, activation=None, error=e)
+                        else:
+                            self.drive_inline(activation)
+                            results[index] = SubmitResult(task=task, activation=activation, error=None)
+            
+            pending = deferred
         
-        except exceptions.InvalidForm as e:
-            raise e
+        return results
+
+    def activate(self, task: models.Task, **kwargs):
+        return self.run(task, **kwargs)
+
+    def run(self, task: models.Task, submit=None, **kwargs):
+        """
+            Activate a task until it reaches a stable state, then drive the 
+            successors running inline within the same transaction.
+        """
+        error = None
+
+        with transaction.atomic(), self.batch(), self.identities():
+            try:
+                activation = self.activate_node(task, submit=submit, **kwargs)
+            except Exception as e:
+                error = e
+            else:
+                self.drive_inline(activation)
         
-        except Exception as e:
-            task.failed(e)
-            task.save()
-            task.process.failed(e)
-            task.process.save()
-            raise e
+        if error is not None:
+            raise error
+        
+        return activation
+
+    def drive_inline(self, activation):
+        pending = list(activation.inlined)
+
+        while pending:
+            try:
+                successor = self.activate_node(pending.pop(0))
+            except Exception:
+                # The failure is recorded on the task and its process.
+                continue
+            
+            pending.extend(successor.inlined)
+
+    def running(self, task):
+        """
+            Stamp the start of the job of a task, out of its activation 
+            transaction, so the sweep sees it running.
+
+            Returns: False if the task changed since it was loaded
+        """
+        return bool(
+            models.Task.objects
+                .filter(id=task.id, version=task.version)
+                .update(started_at=timezone.now())
+        )
+
+    def started(self, flow, task, submitted=False):
+        """
+            Stamp the start of an activation, and measure how long the task waited for it.
+        """
+        now = timezone.now()
 
-    def activate(self, task: models.Task, **kwargs):       
+        if task.dispatched_at is not None and task.started_at is None:
+            METRICS.observe(flow.get_name(), task.step, metrics.QUEUE_WAIT, (now - task.dispatched_at).total_seconds())
+        
+        if submitted and task.finished_at is not None:
+            METRICS.observe(flow.get_name(), task.step, metrics.THINK, (now - task.finished_at).total_seconds())
+
+        task.started_at = now
+
+    def activate_node(self, task: models.Task, submit=None, context=None, **kwargs):       
         from .nodes import node_activation
         
+        identities = getattr(self.local, 'identities', None) or IdentityMap()
+
         try:
-            flow    = self.flow(task.process.flow_class)
-            context = flow.context(task.process)
+            process = identities.process(task)
+            flow    = self.flow(process.flow_class)
+            context = identities.context(flow, process) if context is None else identities.add(context)
             node    = flow.node(task.step)
             
-            with node_activation(task=task, engine=self, context=context) as activation:
+            self.started(flow, task, submit is not None)
+
+            profile = METRICS.profile(flow.get_name(), task.step)
+
+            with TRACER.activation(task, flow, profile), profile, \
+                 node_activation(task=task, engine=self, context=context) as activation:
+                if submit is not None:
+                    node.submit(activation=activation, **submit)
+                
                 node(activation=activation, **kwargs)
                 return activation
 
+        except exceptions.TaskNotStall as e:
+            raise e
+        
+        except exceptions.InvalidForm as e:
+            raise e
+
+        except exceptions.StaleActivation as e:
+            # Another activation wrote the task, it is left as is.
+            identities.evict(task.process)
+            raise e
+
         except Exception as e:
-            task.failed(e)
-            task.process.failed(e)
-            task.save()
-            task.process.save()
+            # Rolled back, their loaded state is stale.
+            identities.evict(task.process)
+
+            if task.status != FAILED:
+                # Failed before its activation, which writes its own failure.
+                task.failed(e)
+                task.process.failed(e)
+                task.save(update_fields=['status', 'log', 'started_at'])
+                task.process.save(update_fields=['status'])
+            
+            NOTIFIER.notify_on_commit()
             raise e
 
+def _headers(task):
+    traceparent = getattr(task, 'traceparent', None)
+    return {} if traceparent is None else {'headers': {'traceparent': traceparent}}
+
 ENGINE = Engine()
\ No newline at end of file
@@ -4,3 +4,21 @@ class InvalidForm(Exception):
 
 class TaskNotStall(Exception):
     pass
+
+class StaleActivation(Exception):
+    """
+        The task changed since it was loaded, the activation is rolled back.
+    """
+    def __init__(self, task):
+        super().__init__(f'"{task}" changed during its activation')
+        self.task = task
+
+class ActivationTimeout(Exception):
+    def __init__(self, task):
+        super().__init__(f'timed out waiting for "{task}"')
+        self.task = task
+
+class InvalidFlow(Exception):
+    def __init__(self, flow, reason):
+        super().__init__(f'invalid flow "{flow.__name__}": {reason}')
+        self.flow = flow
@@ -1,5 +1,7 @@
+import abc
 from .nodes  import BaseNode, End
 from .engine import ENGINE
+from .graph import FlowGraph
 from . import exceptions
 
 class SelfClassAttribute:
@@ -25,6 +27,7 @@ Self = SelfObject()
 class WorkflowMeta(type):   
     def __new__(cls, name, bases, attrs, abstract=False):
         cls = super().__new__(cls, name, bases, attrs)
+        cls.steps = {**cls.steps}
 
         for key, value in attrs.items():
             if isinstance(value, BaseNode):
@@ -34,40 +37,81 @@ class WorkflowMeta(type):
                 value.resolve(cls)
 
         if not abstract:
+            cls.graph = FlowGraph(cls, cls.steps)
             ENGINE.register(cls)
         
         return cls
 
-class SimpleContextFactory:
+class ContextFactory(abc.ABC):
     requires_form_submission = False
-    
+
+    @abc.abstractmethod
+    def build(self, context_class, process, **kwargs):
+        """
+            Returns an unsaved context
+        """
+
+    def build_many(self, context_class, kwargs_list):
+        """
+            Returns unsaved contexts, their processes are set by the caller.
+        """
+        return [
+            self.build(context_class, None, **kwargs) 
+            for kwargs in kwargs_list
+        ]
+
     def __call__(self, context_class, process, **kwargs):
-        context = context_class(process=process)
+        context = self.build(context_class, process, **kwargs)
         context.save()
-        result.set_context(context)
         return context
 
-class FormBasedContextFactory:
+class SimpleContextFactory(ContextFactory):
+    requires_form_submission = False
+    
+    def build(self, context_class, process, **kwargs):
+        return context_class(process=process)
+
+class FormBasedContextFactory(ContextFactory):
     requires_form_submission = True
 
     def __init__(self, form_class):
         self.form_class = form_class
 
-    def __call__(self, context_class, process, files=None, **kwargs):
+    def build(self, context_class, process, files=None, **kwargs):
         form = self.form_class(**kwargs['form_kwargs'])
 
         if form.is_valid():
             context = form.save(commit=False)
             context.process = process
-            context.save()
             return context
 
         else:
             raise exceptions.InvalidForm(form)
+    
+    def build_many(self, context_class, kwargs_list):
+        """
+            Validate every form before building the contexts, 
+            raise on the first invalid one.
+        """
+        forms = [self.form_class(**kwargs['form_kwargs']) for kwargs in kwargs_list]
+
+        for form in forms:
+            if not form.is_valid():
+                raise exceptions.InvalidForm(form)
+        
+        return [form.save(commit=False) for form in forms]
         
 class Workflow(metaclass=WorkflowMeta, abstract=True):
     context_class = None
     context_factory = SimpleContextFactory()
+    # Activate the spawned tasks in the worker of their predecessor, 
+    # can be overriden per node.
+    inline = False
+    # The routing of the activations, can be overriden per node, see routing.Route
+    queue = None
+    priority = None
+    rate_limit = None
+    partitions = None
     
     steps = {
         'end': End()
@@ -85,7 +129,7 @@ class Workflow(metaclass=WorkflowMeta, abstract=True):
             
     @classmethod
     def node(cls, step):
-        return cls.steps[step]
+        return cls.graph.node(step)
 
     @classmethod
     def context(cls, process):
@@ -0,0 +1,102 @@
+from types import MappingProxyType
+from .routing import Route
+from . import exceptions
+
+class FlowGraph:
+    """
+        The compiled graph of a workflow, built once by WorkflowMeta.
+
+        Steps are numbered, and the successors, the fan-out and the
+        execution policy of every node are precomputed. Every step must be
+        reachable from start, and an end reachable from start.
+    """
+    def __init__(self, flow, steps):
+        self.flow = flow
+        self.steps = tuple(steps)
+        self.ids = MappingProxyType({step: id for id, step in enumerate(self.steps)})
+        self.nodes = tuple(steps[step] for step in self.steps)
+
+        if 'start' not in self.ids:
+            raise exceptions.InvalidFlow(flow, 'missing "start" step')
+
+        for step, node in zip(self.steps, self.nodes):
+            for successor in node.successors():
+                if successor not in self.ids:
+                    raise exceptions.InvalidFlow(flow, f'"{step}" leads to the missing step "{successor}"')
+
+        self.successors = tuple(
+            tuple(self.ids[successor] for successor in node.successors())
+            for node in self.nodes
+        )
+        self.predecessors = tuple(
+            tuple(id for id, successors in enumerate(self.successors) if successor in successors)
+            for successor in range(len(self.nodes))
+        )
+        self.fanouts = tuple(node.fanout for node in self.nodes)
+        self.inline = tuple(
+            flow.inline if node.inline is None else node.inline
+            for node in self.nodes
+        )
+        self.routes = tuple(Route.of(flow, node) for node in self.nodes)
+        self.terminals = frozenset(
+            id for id, node in enumerate(self.nodes) if node.terminal
+        )
+        self.reachables = self._reachables(self.ids['start'])
+        self.terminating = self._terminating()
+
+        if self.ids['start'] not in self.terminating:
+            raise exceptions.InvalidFlow(flow, 'no end can be reached from "start"')
+        
+        unreachables = [step for id, step in enumerate(self.steps) if id not in self.reachables]
+
+        if unreachables:
+            raise exceptions.InvalidFlow(flow, 'unreachable steps {}'.format(', '.join(f'"{step}"' for step in unreachables)))
+
+    def id(self, step):
+        try:
+            return self.ids[step]
+        except KeyError:
+            raise exceptions.InvalidFlow(self.flow, f'missing step "{step}"')
+
+    def node(self, step):
+        return self.nodes[self.id(step)]
+
+    def runs_inline(self, step):
+        return self.inline[self.id(step)]
+
+    def route(self, step):
+        return self.routes[self.id(step)]
+
+    def is_reachable(self, step):
+        return self.id(step) in self.reachables
+
+    def can_terminate(self, step):
+        """
+            Returns True if an end node can be reached from the step.
+        """
+        return self.id(step) in self.terminating
+
+    def _reachables(self, start):
+        reachables = {start}
+        pending = [start]
+
+        while pending:
+            for successor in self.successors[pending.pop()]:
+                if successor not in reachables:
+                    reachables.add(successor)
+                    pending.append(successor)
+
+        return frozenset(reachables)
+
+    def _terminating(self):
+        predecessors = self.predecessors
+        terminating = set(self.terminals)
+        pending = list(terminating)
+
+        while pending:
+            for predecessor in predecessors[pending.pop()]:
+                if predecessor not in terminating:
+                    terminating.add(predecessor)
+                    pending.append(predecessor)
+
+        return frozenset(terminating)
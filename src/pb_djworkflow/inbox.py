@@ -0,0 +1,87 @@
+from collections import Counter
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F
+
+from .status import STALL
+
+def is_open(task):
+    """
+        Returns True if the task waits for one of its assignees.
+    """
+    return task.status == STALL and (
+        task.assigned_to_user_id is not None 
+        or task.assigned_to_group_id is not None
+    )
+
+def sync(*tasks):
+    """
+        Recompute the inbox entries of the tasks, and the counts of their users.
+    """
+    from .models import InboxEntry, InboxCounter
+
+    tasks = [task for task in tasks if task.pk is not None]
+    groups = {task.assigned_to_group_id for task in tasks if is_open(task)}
+    members = {}
+    
+    if groups - {None}:
+        for group_id, user_id in User.groups.through.objects\
+            .filter(group_id__in=groups - {None})\
+            .values_list('group_id', 'user_id'):
+            members.setdefault(group_id, set()).add(user_id)
+
+    expected = set()
+
+    for task in filter(is_open, tasks):
+        if task.assigned_to_user_id is not None:
+            expected.add((task.assigned_to_user_id, task.id))
+
+        expected.update((user_id, task.id) for user_id in members.get(task.assigned_to_group_id, ()))
+
+    existing = {
+        (user_id, task_id): id for id, user_id, task_id in InboxEntry.objects
+            .filter(task__in=tasks)
+            .values_list('id', 'user_id', 'task_id')
+    }
+
+    removed = [id for key, id in existing.items() if key not in expected]
+    added = [key for key in expected if key not in existing]
+
+    if not removed and not added:
+        return
+
+    with transaction.atomic():
+        InboxEntry.objects.filter(id__in=removed).delete()
+        InboxEntry.objects.bulk_create([
+            InboxEntry(user_id=user_id, task_id=task_id) 
+            for user_id, task_id in added
+        ])
+
+        deltas = Counter(user_id for user_id, _ in added)
+        deltas.subtract(user_id for (user_id, _), id in existing.items() if id in removed)
+        
+        InboxCounter.objects.bulk_create(
+            [InboxCounter(user_id=user_id) for user_id in deltas],
+            ignore_conflicts=True
+        )
+
+        for user_id, delta in deltas.items():
+            if delta:
+                InboxCounter.objects.filter(user_id=user_id).update(count=F('count') + delta)
+
+def close(ids):
+    """
+        Remove the inbox entries of tasks closed in SQL, and update the counts of their users.
+    """
+    from .models import InboxEntry, InboxCounter
+
+    entries = list(InboxEntry.objects.filter(task_id__in=list(ids)).values_list('id', 'user_id'))
+
+    if not entries:
+        return
+
+    with transaction.atomic():
+        InboxEntry.objects.filter(id__in=[id for id, _ in entries]).delete()
+
+        for user_id, count in Counter(user_id for _, user_id in entries).items():
+            InboxCounter.objects.filter(user_id=user_id).update(count=F('count') - count)
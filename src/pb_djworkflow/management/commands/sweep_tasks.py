@@ -0,0 +1,24 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+
+from pb_djworkflow.engine import ENGINE
+
+class Command(BaseCommand):
+    help = 'Redispatch the pending tasks whose activation was lost.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=600, help='Seconds since the task was dispatched, or created.')
+        parser.add_argument('--chunk-size', type=int, default=500)
+        parser.add_argument('--dry-run', action='store_true', help='Only count the stuck tasks.')
+
+    def handle(self, *args, **options):
+        stats = ENGINE.sweep(
+            older_than=timedelta(seconds=options['older_than']),
+            chunk_size=options['chunk_size'],
+            dry_run=options['dry_run']
+        )
+
+        self.stdout.write(
+            '{stuck} stuck, {running} running, {redispatched} redispatched '
+            'in {seconds:.2f}s ({per_second:.0f} tasks/s)'.format(**stats)
+        )
@@ -0,0 +1,130 @@
+import bisect, threading, time
+from django.db import connection
+
+# Upper bounds, in seconds, of the latency buckets.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60, 300, 3600, 86400)
+# Upper bounds of the query count buckets.
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+# Time from the dispatch to the start of the activation.
+QUEUE_WAIT = 'queue_wait'
+# Time of an activation, measured in the worker.
+WALL = 'wall'
+# Queries run by an activation.
+QUERIES = 'queries'
+# Time from the stall of a user action to its submission.
+THINK = 'think'
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # The last one counts the values above every bound.
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q):
+        """
+            Returns the upper bound of the bucket holding the quantile.
+        """
+        if not self.count:
+            return None
+
+        rank = q * self.count
+        seen = 0
+
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+
+            if seen >= rank:
+                return bound
+
+        return self.max
+
+    def to_json(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'mean': self.sum / self.count if self.count else None,
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'buckets': dict(zip([*map(str, self.buckets), '+Inf'], self.counts)),
+        }
+
+class Metrics:
+    """
+        Histograms of the activations, per flow, step and metric,
+        aggregated in the process of the worker.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def observe(self, flow, step, metric, value):
+        key = (flow, step, metric)
+
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = Histogram(COUNT_BUCKETS if metric == QUERIES else LATENCY_BUCKETS)
+
+            self.histograms[key].observe(value)
+
+    def get(self, flow, step, metric):
+        return self.histograms.get((flow, step, metric))
+
+    def profile(self, flow, step):
+        """
+            Measure the wall-clock time and the queries of a block.
+        """
+        return Profile(self, flow, step)
+
+    def snapshot(self):
+        """
+            Returns the histograms as {flow: {step: {metric: histogram}}}.
+        """
+        with self.lock:
+            snapshot = {}
+
+            for (flow, step, metric), histogram in sorted(self.histograms.items()):
+                snapshot.setdefault(flow, {}).setdefault(step, {})[metric] = histogram.to_json()
+
+            return snapshot
+
+    def reset(self):
+        with self.lock:
+            self.histograms = {}
+
+class Profile:
+    def __init__(self, metrics, flow, step):
+        self.metrics = metrics
+        self.flow = flow
+        self.step = step
+        self.queries = 0
+        self.wall = None
+
+    def __enter__(self):
+        self.wrapper = connection.execute_wrapper(self.count)
+        self.wrapper.__enter__()
+        self.start = time.perf_counter()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self.wall = time.perf_counter() - self.start
+        self.wrapper.__exit__(*exc_info)
+        self.metrics.observe(self.flow, self.step, WALL, self.wall)
+        self.metrics.observe(self.flow, self.step, QUERIES, self.queries)
+
+    def count(self, execute, sql, params, many, context):
+        self.queries += 1
+        return execute(sql, params, many, context)
+
+METRICS = Metrics()
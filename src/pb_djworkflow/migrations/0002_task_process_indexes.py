@@ -0,0 +1,70 @@
+# Generated by Django 4.2 on 2026-10-18 09:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pb_djworkflow', '0001_initial'),
+    ]
+
+    operations = [
+        # The composite indexes are created before the foreign key indexes they replace are dropped
+        migrations.AddIndex(
+            model_name='process',
+            index=models.Index(fields=['flow_class', 'status'], name='pb_process_flow_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='process',
+            index=models.Index(fields=['status'], name='pb_process_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['process', 'step'], name='pb_task_process_step_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['status', 'step'], name='pb_task_status_step_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['assigned_to_user', 'status'], name='pb_task_user_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['assigned_to_group', 'status'], name='pb_task_group_status_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('status__in', ('init', 'ready', 'submitted', 'reentering'))), fields=['id'], name='pb_task_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('subprocess__isnull', False)), fields=['subprocess'], name='pb_task_subprocess_idx'),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='assigned_to_group',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='auth.group'),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='assigned_to_user',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='process',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='tasks', to='pb_djworkflow.process'),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='subprocess',
+            field=models.ForeignKey(blank=True, db_index=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='supratasks', to='pb_djworkflow.process'),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 4.2 on 2026-10-18 09:20
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_inboxes(apps, schema_editor):
+    Task = apps.get_model('pb_djworkflow', 'Task')
+    InboxEntry = apps.get_model('pb_djworkflow', 'InboxEntry')
+    InboxCounter = apps.get_model('pb_djworkflow', 'InboxCounter')
+    Membership = apps.get_model('auth', 'User').groups.through
+    
+    members = {}
+    for group_id, user_id in Membership.objects.values_list('group_id', 'user_id'):
+        members.setdefault(group_id, set()).add(user_id)
+
+    entries = set()
+    for task_id, user_id, group_id in Task.objects\
+        .filter(status='stall')\
+        .values_list('id', 'assigned_to_user_id', 'assigned_to_group_id')\
+        .iterator():
+        if user_id is not None:
+            entries.add((user_id, task_id))
+        entries.update((member_id, task_id) for member_id in members.get(group_id, ()))
+    
+    InboxEntry.objects.bulk_create(
+        [InboxEntry(user_id=user_id, task_id=task_id) for user_id, task_id in entries], 
+        batch_size=1000
+    )
+
+    counts = {}
+    for user_id, _ in entries:
+        counts[user_id] = counts.get(user_id, 0) + 1
+    
+    InboxCounter.objects.bulk_create(
+        [InboxCounter(user_id=user_id, count=count) for user_id, count in counts.items()], 
+        batch_size=1000
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('pb_djworkflow', '0002_task_process_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='InboxCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='inbox_counter', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('count', models.IntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='InboxEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('task', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox_entries', to='pb_djworkflow.task')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='inboxentry',
+            constraint=models.UniqueConstraint(fields=('user', 'task'), name='pb_inbox_user_task_uniq'),
+        ),
+        migrations.RunPython(fill_inboxes, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-18 09:25
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('pb_djworkflow', '0003_inbox'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='inboxentry',
+            index=models.Index(fields=['user', 'id'], name='pb_inbox_user_id_idx'),
+        ),
+        migrations.AlterField(
+            model_name='inboxentry',
+            name='user',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='inbox', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 09:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pb_djworkflow', '0005_task_timestamps'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='process',
+            name='closed_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='process',
+            name='created_at',
+            field=models.DateTimeField(auto_now_add=True),
+        ),
+    ]
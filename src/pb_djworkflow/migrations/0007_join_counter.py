@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 09:45
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pb_djworkflow', '0006_process_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='process',
+            name='supratask',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='subprocesses', to='pb_djworkflow.task'),
+        ),
+        migrations.CreateModel(
+            name='JoinCounter',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('step', models.CharField(max_length=255)),
+                ('arrived', models.IntegerField(default=0)),
+                ('expected', models.IntegerField()),
+                ('process', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='join_counters', to='pb_djworkflow.process')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='joincounter',
+            constraint=models.UniqueConstraint(fields=('process', 'step'), name='pb_join_process_step_uniq'),
+        ),
+    ]
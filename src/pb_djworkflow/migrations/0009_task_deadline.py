@@ -0,0 +1,35 @@
+# Generated by Django 4.2 on 2026-10-18 09:51
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pb_djworkflow', '0008_task_version'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='task',
+            name='pb_task_pending_idx',
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='deadline',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AlterField(
+            model_name='task',
+            name='status',
+            field=models.CharField(choices=[('init', 'Initalised'), ('ready', 'Ready'), ('stall', 'Stall'), ('submitted', 'Submitted'), ('reentering', 'Reentering'), ('expired', 'Expired'), ('aborted', 'Aborted'), ('failed', 'Failed'), ('done', 'Done'), ('closed', 'Closed')], default='init', max_length=20),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('status__in', ('init', 'ready', 'submitted', 'reentering', 'expired'))), fields=['id'], name='pb_task_pending_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(condition=models.Q(('deadline__isnull', False), ('status', 'stall')), fields=['deadline'], name='pb_task_deadline_idx'),
+        ),
+    ]
@@ -1,15 +1,21 @@
-from django.db import models
+from django.db import models, transaction
+from django.utils import timezone
 from django.contrib.auth.models import User, Group
-from celery.result import AsyncResult
 from graphql_relay.node.node import to_global_id
 from .nodes import ActivationEdge
-import datetime
+from .notify import NOTIFIER
+from .status import PENDING, STALL
+from .tracking import DirtyFieldsMixin
+from . import inbox
+from . import exceptions
 
-class Process(models.Model):
-    created_at = models.DateField(auto_now_add=True)
-    closed_at = models.DateField(null=True)
+class Process(DirtyFieldsMixin, models.Model):
+    created_at = models.DateTimeField(auto_now_add=True)
+    closed_at = models.DateTimeField(null=True)
 
     created_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True)
+    # The map task which spawned the process, see nodes.MapSubprocess
+    supratask = models.ForeignKey('Task', on_delete=models.SET_NULL, null=True, blank=True, related_name='subprocesses')
     flow_class = models.CharField(max_length=255)
     
     status = models.CharField(max_length=20, default='init', choices=(
@@ -20,6 +26,12 @@ class Process(models.Model):
         ('done', 'Done')
     ))
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['flow_class', 'status'], name='pb_process_flow_status_idx'),
+            models.Index(fields=['status'], name='pb_process_status_idx'),
+        ]
+
     def get_context(self):
         from .engine import ENGINE
         return ENGINE.context(self)
@@ -36,21 +48,28 @@ class Process(models.Model):
 
     def done(self):
         self.status = 'done'
-        self.closed_at = datetime.date.today()
+        self.closed_at = timezone.now()
 
-class Task(models.Model):
-    created_at = models.DateField(auto_now_add=True)
-    closed_at = models.DateField(null=True, blank=True)
+class Task(DirtyFieldsMixin, models.Model):
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Sent to a worker, none if the task runs inline
+    dispatched_at = models.DateTimeField(null=True, blank=True)
+    # The last activation
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    closed_at = models.DateTimeField(null=True, blank=True)
 
     done_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='tasks_done')
 
-    assigned_to_user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
-    assigned_to_group = models.ForeignKey(Group, on_delete=models.SET_NULL, null=True, blank=True)
+    # Indexed along the status, see Meta.indexes
+    assigned_to_user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, db_index=False)
+    assigned_to_group = models.ForeignKey(Group, on_delete=models.SET_NULL, null=True, blank=True, db_index=False)
     
-    process     = models.ForeignKey(Process, on_delete=models.CASCADE, related_name="tasks")
-    subprocess  = models.ForeignKey(Process, on_delete=models.SET_NULL, null=True, related_name="supratasks", blank=True)
+    process     = models.ForeignKey(Process, on_delete=models.CASCADE, related_name="tasks", db_index=False)
+    subprocess  = models.ForeignKey(Process, on_delete=models.SET_NULL, null=True, related_name="supratasks", blank=True, db_index=False)
 
-    deadline = models.DateField(null=True)
+    # Activated once passed, when the task is stalled, see Engine.fire_deadlines
+    deadline = models.DateTimeField(null=True, blank=True)
 
     step        = models.CharField(max_length=255)
     status      = models.CharField(max_length=20, default='init', choices=(
@@ -58,6 +77,8 @@ class Task(models.Model):
         ('ready', 'Ready'),
         ('stall', 'Stall'),
         ('submitted', 'Submitted'),
+        ('reentering', 'Reentering'),
+        ('expired', 'Expired'),
         ('aborted', 'Aborted'),
         ('failed', 'Failed'),
         ('done', 'Done'),
@@ -65,8 +86,103 @@ class Task(models.Model):
     ))
 
     current_job = models.CharField(max_length=255, null=True, blank=True)
+    # Bumped on every activation, see save_versioned
+    version = models.PositiveIntegerField(default=0)
     previous = models.ForeignKey('self', on_delete=models.SET_NULL, null=True, related_name="followings", blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['process', 'step'], name='pb_task_process_step_idx'),
+            models.Index(fields=['status', 'step'], name='pb_task_status_step_idx'),
+            models.Index(fields=['assigned_to_user', 'status'], name='pb_task_user_status_idx'),
+            models.Index(fields=['assigned_to_group', 'status'], name='pb_task_group_status_idx'),
+            # Only the few tasks waiting for an activation
+            models.Index(fields=['id'], name='pb_task_pending_idx', condition=models.Q(status__in=PENDING)),
+            # Only the stalled tasks with a deadline, in the order they expire
+            models.Index(fields=['deadline'], name='pb_task_deadline_idx', condition=models.Q(status=STALL, deadline__isnull=False)),
+            # Only the supratasks
+            models.Index(fields=['subprocess'], name='pb_task_subprocess_idx', condition=models.Q(subprocess__isnull=False)),
+        ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._inbox_key = None
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        task = super().from_db(db, field_names, values)
+        
+        # Unknown, the inbox is synced on save.
+        if not task.get_deferred_fields() & {'status', 'assigned_to_user_id', 'assigned_to_group_id'}:
+            task._inbox_key = task.inbox_key()
+        else:
+            task._inbox_key = ()
+        
+        return task
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self._inbox_key = self.inbox_key()
+
+    def inbox_key(self):
+        if not inbox.is_open(self):
+            return None
+        
+        return (self.assigned_to_user_id, self.assigned_to_group_id)
+
+    def save(self, *args, **kwargs):
+        """
+            Save the task, and its inbox entries if it opened, closed or was reassigned.
+        """
+        if self.inbox_key() == self._inbox_key:
+            return super().save(*args, **kwargs)
+        
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            inbox.sync(self)
+        
+        self._inbox_key = self.inbox_key()
+
+    def save_versioned(self, fields=None):
+        """
+            Write the changed columns, among fields if given, and bump the 
+            version, only if the row is still at the loaded version and status.
+
+            Returns False, without writing, if the task changed meanwhile.
+            Called within the transaction of the activation.
+        """
+        saved_state = getattr(self, '_saved_state', None)
+
+        if self._state.adding or saved_state is None:
+            self.save(update_fields=fields)
+            return True
+
+        fields = [
+            self._meta.get_field(name) for name in self.get_dirty_fields() 
+            if name != 'version' and (fields is None or name in fields)
+        ]
+        
+        updated = Task.objects.filter(
+            id=self.id, 
+            version=self.version, 
+            status=saved_state.get('status', self.status)
+        ).update(
+            version=models.F('version') + 1,
+            **{field.attname: getattr(self, field.attname) for field in fields}
+        )
+
+        if not updated:
+            return False
+        
+        self.version += 1
+        self.mark_clean([field.attname for field in fields] + ['version'])
+
+        if self.inbox_key() != self._inbox_key:
+            inbox.sync(self)
+            self._inbox_key = self.inbox_key()
+        
+        return True
+
     def toJSON(self):
         return {
             'id': self.id,
@@ -87,8 +203,8 @@ class Task(models.Model):
         self.status = 'ready'
 
     def closed(self):
-        self.closed = 'closed'
-        self.closed_at = datetime.date.today()
+        self.status = 'closed'
+        self.closed_at = timezone.now()
 
     def aborted(self):
         self.status = 'aborted'
@@ -100,20 +216,83 @@ class Task(models.Model):
     def done(self):
         self.status = 'done'
 
-    def get_edge(self, *args, **kwargs):
-        from django_celery_results.models import TaskResult
+    def wait(self, statuses, timeout=None):
+        """
+            Wait until the task reaches one of the statuses.
+        """
+        def reached():
+            self.refresh_from_db(fields=['status'])
+            return self.status in statuses
         
-        if self.current_job is not None:
-            result = AsyncResult(self.current_job)
-            result = result.get(*args, **kwargs)
-            self.refresh_from_db()
-            return ActivationEdge.from_json(result)
+        if not NOTIFIER.wait(reached, timeout=timeout):
+            raise exceptions.ActivationTimeout(self)
+
+    def get_edge(self, timeout=None):
+        """
+            Wait for the activation of the task, and returns the edge to its successors.
+        """
+        return ActivationEdge.resolve([self], timeout=timeout)[0]
+
+class JoinCounter(models.Model):
+    """
+        The tasks arrived at a join step of a process, incremented in SQL.
+    """
+    process = models.ForeignKey(Process, on_delete=models.CASCADE, related_name='join_counters', db_index=False)
+    step = models.CharField(max_length=255)
+    arrived = models.IntegerField(default=0)
+    expected = models.IntegerField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['process', 'step'], name='pb_join_process_step_uniq')
+        ]
+
+    @classmethod
+    def arrive(cls, process_id, step, expected=None):
+        """
+            Count an arrival, returns True for the one completing the join.
+
+            The row stays locked until the transaction ends, the arrivals 
+            of the process are serialized.
+        """
+        counters = cls.objects.filter(process_id=process_id, step=step)
+
+        if not counters.update(arrived=models.F('arrived') + 1):
+            # The first arrival, unless another one created the row meanwhile.
+            _, created = cls.objects.get_or_create(
+                process_id=process_id, 
+                step=step, 
+                defaults={'arrived': 1, 'expected': expected}
+            )
+
+            if not created:
+                counters.update(arrived=models.F('arrived') + 1)
         
-        else:
-            self.refresh_from_db()
-            return ActivationEdge(self)
+        arrived, expected = counters.values_list('arrived', 'expected').get()
+        return arrived == expected
+
+class InboxEntry(models.Model):
+    """
+        An open task, for one of its assignees.
+    """
+    # Covered by the constraint and the index below.
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='inbox', db_index=False)
+    task = models.ForeignKey(Task, on_delete=models.CASCADE, related_name='inbox_entries')
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['user', 'task'], name='pb_inbox_user_task_uniq')
+        ]
+        indexes = [
+            # The inbox of a user, paged in the order the tasks opened.
+            models.Index(fields=['user', 'id'], name='pb_inbox_user_id_idx'),
+        ]
+
+class InboxCounter(models.Model):
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='inbox_counter')
+    count = models.IntegerField(default=0)
 
-class WorkflowContext(models.Model):
+class WorkflowContext(DirtyFieldsMixin, models.Model):
     process = models.ForeignKey(Process, on_delete=models.CASCADE)
     
     class Meta:
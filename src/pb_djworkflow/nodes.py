@@ -1,22 +1,32 @@
-from .tasks import activate, spawn_flow
-from .status import READY, INIT, DONE, CLOSED, STALL, FAILED, ABORTED, SUBMITTED, REENTERING
+from .tasks import spawn_flow, spawn_flows
+from .status import READY, INIT, DONE, CLOSED, STALL, FAILED, ABORTED, SUBMITTED, REENTERING, EXPIRED, QUIESCENT, FINAL
+from .notify import NOTIFIER
+from .tracing import TRACER
 from . import signals, exceptions, models
 from contextlib import contextmanager
+from datetime import timedelta
 from django.db import transaction
+from django.utils import timezone
+from django.db.models import Prefetch
 
 @contextmanager
 def node_activation(task, engine, context):
     activation = NodeActivation(task, engine, context)
 
     try:
-        yield activation
+        # A stale commit rolls back the whole activation.
+        with transaction.atomic():
+            yield activation
+            activation.commit()
     
+    except (exceptions.TaskNotStall, exceptions.InvalidForm, exceptions.StaleActivation) as e:
+        # The submission is rejected, or another activation won, 
+        # the task is left untouched.
+        raise e
+
     except Exception as e:
-        activation.failed(e)
+        activation.commit_failure(e)
         raise e
-    
-    finally:
-        activation.commit()
 
 class ActivationEdge:
     
@@ -45,39 +55,70 @@ class ActivationEdge:
                     self.nexts
                 )
             )
-            return task.get_edge(*args, **kwargs)
+            return ActivationEdge.resolve([task], *args, **kwargs)[0]
         
         except StopIteration:
             raise ActivationEdge.NotFound(step)
 
-    def loopback(self):
+    def until(self, status, timeout=None):
         """
-            Loopback on a task.
+            Wait until the task reaches the status, or cannot reach it anymore.
         """
-        
-        for task in self.nexts:
-            if task.id == self.task.id:
-                return task.get_edge()
-        
-        return None
-
-    def until(self, status):
         if self.task.status == status:
             return self
         
-        return self.loopback().until(status)
+        self.task.wait((status, *FINAL), timeout=timeout)
+        return ActivationEdge.resolve([self.task], timeout=timeout)[0]
 
-    def until_closed(self):
-        return self.until(CLOSED)
+    def until_closed(self, timeout=None):
+        return self.until(CLOSED, timeout=timeout)
 
-    def until_stall(self):
-        return self.until(STALL)
+    def until_stall(self, timeout=None):
+        return self.until(STALL, timeout=timeout)
 
     def get_edges(self, *args, **kwargs):
         """
             Wait for the next activations and returns their links
         """   
-        yield from map(lambda task: task.get_edge(*args, **kwargs), self.nexts)
+        yield from ActivationEdge.resolve(self.nexts, *args, **kwargs)
+
+    @staticmethod
+    def resolve(tasks, timeout=None):
+        """
+            Wait for the activation of the tasks, and returns their edges.
+
+            The tasks, their processes and their followings are loaded in two queries.
+        """
+        ids = [task.id for task in tasks]
+        pending = ids
+
+        def activated():
+            nonlocal pending
+            pending = list(
+                models.Task.objects
+                .filter(id__in=pending)
+                .exclude(status__in=QUIESCENT)
+                .values_list('id', flat=True)
+            )
+            return not pending
+
+        if not NOTIFIER.wait(activated, timeout=timeout):
+            raise exceptions.ActivationTimeout(next(task for task in tasks if task.id == pending[0]))
+
+        loaded = models.Task.objects\
+            .select_related('process')\
+            .prefetch_related(
+                Prefetch(
+                    'followings', 
+                    queryset=models.Task.objects.select_related('process')
+                )
+            )\
+            .in_bulk(ids)
+        
+        return [
+            ActivationEdge(loaded[id], *loaded[id].followings.all()) 
+            for id in ids
+        ]
 
     @staticmethod
     def from_flow_spawn(flow_spawn):
@@ -85,12 +126,14 @@ class ActivationEdge:
 
     @staticmethod
     def from_json(json):
-        task = models.Task.objects.get(id=json['current'])
-        nexts = list(map(
-            lambda t: models.Task.objects.get(id=t), 
-            json['nexts']
-        ))
-        return ActivationEdge(task, *nexts)
+        loaded = models.Task.objects\
+            .select_related('process')\
+            .in_bulk([json['current'], *json['nexts']])
+
+        return ActivationEdge(
+            loaded[json['current']], 
+            *map(lambda t: loaded[t], json['nexts'])
+        )
 
     def to_json(self):
         return {
@@ -102,9 +145,10 @@ class NodeActivation:
     def __init__(self, task, engine, context, **kwargs):
         self.engine = engine
         self.task = task
-        self.spawn_cmds = []
+        self.spawn_steps = []
         self.context = context
         self.nexts = []
+        self.inlined = []
 
     def to_edge(self):
         return ActivationEdge(self.task, *self.nexts)
@@ -113,31 +157,70 @@ class NodeActivation:
         return iter(self.nexts)
 
     def commit(self):
-        self.task.save()
-        self.task.process.save()
-        self.context.save()
-
-        if self.task.status in (READY, SUBMITTED):
-            job = activate.delay(
-                self.task.id
-            ) 
-            self.task.current_job = job.task_id
-            self.task.save()
-            job.forget()
-            self.nexts.append(self.task)
-
-        for cmd in self.spawn_cmds:
-            task_spawn = cmd()
-            self.nexts.append(task_spawn.task)
+        """
+            Write the task, the process, the context and the spawned tasks 
+            in one transaction, the activations are dispatched once committed.
+        """
+        dispatched = []
+
+        for step in self.spawn_steps:
+            task = self.engine.new_task(step, self.task.process, previous=self.task)
             
+            if self.engine.runs_inline(task):
+                self.inlined.append(task)
+            else:
+                dispatched.append(self.engine.reserve_job(task))
+
+        if self.is_quiescent():
+            self.task.finished_at = timezone.now()
+
+            if self.task.status == CLOSED and self.task.closed_at is None:
+                self.task.closed_at = self.task.finished_at
+
+        with transaction.atomic():
+            # Only the changed columns are written, if any.
+            self.task.process.save()
+            self.context.save()
+
+            models.Task.objects.bulk_create(dispatched + self.inlined)
+            
+            for task in dispatched + self.inlined:
+                task.mark_clean()
+                task.traceparent = TRACER.traceparent(task)
+
+            # Last, if another activation wrote the task meanwhile, 
+            # everything above is rolled back and nothing is dispatched.
+            if not self.task.save_versioned():
+                raise exceptions.StaleActivation(self.task)
+
+            if self.task.status == FAILED:
+                self.fail_workflow()
+
+            self.nexts.extend(dispatched + self.inlined)
+
+            self.engine.dispatch(*dispatched)
+            NOTIFIER.notify_on_commit()
+            
+    def commit_failure(self, error):
+        """
+            Write the failure of the task and of its process, and nothing 
+            else of the activation, which was rolled back.
+        """
+        # Neither successors, nor changes of the context
+        self.spawn_steps, self.inlined = [], []
+        self.failed(error)
+        self.task.finished_at = timezone.now()
+
+        with transaction.atomic():
+            # Nothing is written, nor notified, if another activation won.
+            if not self.task.save_versioned(['status', 'log', 'started_at', 'finished_at']):
+                raise exceptions.StaleActivation(self.task)
+            
+            self.fail_workflow()
+            NOTIFIER.notify_on_commit()
+
     def spawn_task(self, step):
-        self.spawn_cmds.append(
-            lambda: self.engine.spawn_task(
-                step, 
-                self.task.process, 
-                previous=self.task
-            )
-        )
+        self.spawn_steps.append(step)
 
     def close_workflow(self):
         self.task.done()
@@ -145,8 +228,14 @@ class NodeActivation:
         # Notify closure
         signals.closed_workflow.send(self, process=self.task.process)
 
+    def is_quiescent(self):
+        return self.task.status in QUIESCENT
+
     def can_be_activated(self):
-        return self.task.status in (READY, STALL, SUBMITTED, REENTERING)
+        return self.task.status in (READY, STALL, SUBMITTED, REENTERING, EXPIRED)
+
+    def is_expired(self):
+        return self.task.status == EXPIRED
 
     def is_entering(self):
         return self.task.status == INIT
@@ -168,12 +257,22 @@ class NodeActivation:
         self.process.status = ABORTED
     
     def failed(self, error):
-        self.task.process.status = FAILED
+        # The process fails once the task is written, see fail_workflow
         self.task.status = FAILED
         self.task.log = str(error)
+
+    def fail_workflow(self):
+        process = self.task.process
         # Notify failure
         signals.failed_task.send(self, task=self.task)
-        signals.failed_workflow.send(self, process=self.task.process)
+
+        # Only the first failed task of a process fails the workflow.
+        first = models.Process.objects.filter(id=process.id).exclude(status=FAILED).update(status=FAILED)
+        process.status = FAILED
+        process.mark_clean(['status'])
+
+        if first:
+            signals.failed_workflow.send(self, process=process)
     
     def ready(self):
         self.task.status = READY
@@ -185,7 +284,23 @@ class NodeActivation:
         self.task.status = CLOSED
 
 class BaseNode:
+    # The number of tasks spawned by an activation, as (min, max).
+    fanout = (0, 0)
+    # The node closes the workflow.
+    terminal = False
+    # The keyword options common to every node, the others name branches.
+    options = ('enter', 'leave', 'inline', 'queue', 'priority', 'rate_limit', 'partitions')
+
     def __init__(self, **options):
+        # Run the node in the worker of its predecessor, instead of dispatching it.
+        # None defers to the flow policy.
+        self.inline = options.pop('inline', None)
+        # The routing of the activations, None defers to the flow, see routing.Route
+        self.queue = options.pop('queue', None)
+        self.priority = options.pop('priority', None)
+        self.rate_limit = options.pop('rate_limit', None)
+        self.partitions = options.pop('partitions', None)
+
         if 'enter' in options:
             self.enter = options['enter']
             del options['enter']
@@ -201,11 +316,35 @@ class BaseNode:
     def resolve(self, flow_class):
         pass
 
+    def successors(self):
+        """
+            Returns the steps the node can spawn.
+        """
+        return ()
+
     def __call__(self, activation, **input):
+        """
+            Run the state machine until the task reaches a stable state.
+        """
+        while not activation.is_quiescent():
+            status = activation.task.status
+            self.step(activation, **input)
+
+            if activation.task.status == status:
+                break
+            
+            TRACER.add_event('status', to=activation.task.status)
+
+        return activation
+
+    def step(self, activation, **input):
         if activation.is_entering():
             self.on_entering(activation, **input)
             activation.ready()          
 
+        if activation.is_expired():
+            signals.expired_task.send(sender=self.__class__, task=activation.task)
+
         if activation.can_be_activated():
             self.activate(
                 activation=activation, 
@@ -216,8 +355,6 @@ class BaseNode:
             self.on_leaving(activation, **input)
             activation.close()
 
-        return activation
-
     def on_entering(self, activation, **input):
         signals.entering_task.send(sender=self.__class__, task=activation.task)
         
@@ -231,14 +368,15 @@ class BaseNode:
             self.leave(activation, **input)
 
 class Branch(BaseNode):
+    fanout = (1, 1)
+
     def __init__(self, default, **kwargs):
         super().__init__(**kwargs)
-        exclude = ['enter', 'leave']
         self.default = default
         branches = {}
         
         for k, v in kwargs.items():
-            if k not in exclude:
+            if k not in self.options:
                 branches[k] = v
         
         self.branches = branches
@@ -249,6 +387,9 @@ class Branch(BaseNode):
             if isinstance(branch, flows.SelfClassAttribute):
                 self.branches[branch_name] = branch(flow_class)
 
+    def successors(self):
+        return (*self.branches, self.default)
+
     def activate(self, activation, **kwargs):
         for branch, predicate in self.branches.items():
             if predicate(activation, **kwargs):
@@ -259,11 +400,81 @@ class Branch(BaseNode):
         activation.spawn_task(self.default)
         activation.done()
 
+class Split(BaseNode):
+    """
+        Spawn every step of nexts, and every branch whose predicate holds.
+    """
+    def __init__(self, *nexts, **kwargs):
+        super().__init__(**kwargs)
+        self.nexts = nexts
+        self.branches = {k: v for k, v in kwargs.items() if k not in self.options}
+        self.fanout = (len(self.nexts), len(self.nexts) + len(self.branches))
+
+    def resolve(self, flow_class):
+        from . import flows
+        for branch_name, branch in self.branches.items():
+            if isinstance(branch, flows.SelfClassAttribute):
+                self.branches[branch_name] = branch(flow_class)
+
+    def successors(self):
+        return (*self.nexts, *self.branches)
+
+    def activate(self, activation, **kwargs):
+        for step in self.nexts:
+            activation.spawn_task(step)
+
+        for branch, predicate in self.branches.items():
+            if predicate(activation, **kwargs):
+                activation.spawn_task(branch)
+        
+        activation.done()
+
+class Join(BaseNode):
+    """
+        Wait for wait of the tasks arriving at the step, one per incoming step 
+        by default, the last one spawns next.
+
+        The arrivals are counted in one row per process, a join completes 
+        once per process.
+    """
+    fanout = (0, 1)
+
+    def __init__(self, next, wait=None, **options):
+        super().__init__(**options)
+        self.next = next
+        self.wait = wait
+
+    def successors(self):
+        return (self.next,)
+
+    def expected(self, activation):
+        if self.wait is None:
+            graph = activation.engine.flow(activation.task.process.flow_class).graph
+            return len(graph.predecessors[graph.id(activation.task.step)])
+
+        if callable(self.wait):
+            return self.wait(activation)
+        
+        return self.wait
+
+    def activate(self, activation, **input):
+        task = activation.task
+
+        if models.JoinCounter.arrive(task.process_id, task.step, self.expected(activation)):
+            activation.spawn_task(self.next)
+        
+        activation.done()
+
 class Job(BaseNode):
+    fanout = (1, 1)
+
     def __init__(self, fn, next, **options):
         super().__init__(**options)
         self.fn = fn
         self.next = next
+
+    def successors(self):
+        return (self.next,)
     
     def activate(self, activation, **input):
         self.fn(activation, **input)
@@ -271,12 +482,17 @@ class Job(BaseNode):
         activation.done()
 
 class Subprocess(BaseNode):
-    def __init__(self, subflow, get_spawn_kwargs, on_result, *args, **kwargs):
+    def __init__(self, subflow, get_spawn_kwargs, on_result, *args, next=None, **kwargs):
         super().__init__(*args, **kwargs)
         
         self.get_spawn_kwargs = get_spawn_kwargs
         self.subflow = subflow
         self.on_result = on_result
+        self.next = next
+        self.fanout = (0, 0) if next is None else (1, 1)
+
+    def successors(self):
+        return () if self.next is None else (self.next,)
 
     def reenter(self, activation, **input):
         """
@@ -287,9 +503,11 @@ class Subprocess(BaseNode):
         
         else:
             self.on_result(activation)
-            activation.context.save()
             activation.done()
 
+            if self.next is not None:
+                activation.spawn_task(self.next)
+
     def spawn_subprocess(self, activation, **kwargs):
         spawn_kwargs = self.get_spawn_kwargs(activation)
         spawn = spawn_flow(self.subflow, **spawn_kwargs)
@@ -300,45 +518,183 @@ class Subprocess(BaseNode):
 
     def activate(self, activation, **input):
         if activation.task.status == READY:
-            self.spawn_subprocess(activation, **kwargs)
+            self.spawn_subprocess(activation, **input)
+
+        if activation.task.status == REENTERING:
+            self.reenter(activation)
+
+class MapSubprocess(BaseNode):
+    """
+        Spawn a subprocess per item, and reenter once they all closed, 
+        or as soon as one failed.
+
+        The closed subprocesses are counted in one row, the supratask is only 
+        reentered by the last one.
+    """
+    def __init__(self, subflow, get_items, get_spawn_kwargs, on_result, *args, next=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        
+        self.subflow = subflow
+        self.get_items = get_items
+        self.get_spawn_kwargs = get_spawn_kwargs
+        self.on_result = on_result
+        self.next = next
+        self.fanout = (0, 0) if next is None else (1, 1)
+
+    def successors(self):
+        return () if self.next is None else (self.next,)
+
+    def spawn_subprocesses(self, activation, **input):
+        task = activation.task
+        kwargs_list = [
+            {**self.get_spawn_kwargs(activation, item), 'supratask': task} 
+            for item in self.get_items(activation)
+        ]
+
+        # Reset, if the step is activated again.
+        models.JoinCounter.objects.update_or_create(
+            process_id=task.process_id, 
+            step=task.step, 
+            defaults={'arrived': 0, 'expected': len(kwargs_list)}
+        )
+        
+        spawn_flows(self.subflow, kwargs_list)
+
+        if kwargs_list:
+            activation.stall()
+        else:
+            self.reenter(activation)
+
+    def reenter(self, activation, **input):
+        """
+            Reenter from the subprocesses, propagate any failure
+        """
+        subprocesses = activation.task.subprocesses.all()
+        failed = subprocesses.filter(status=FAILED).first()
+
+        if failed is not None:
+            activation.failed(f'subprocess failed: "{failed}"')
+        
+        else:
+            self.on_result(activation, subprocesses)
+            activation.done()
+
+            if self.next is not None:
+                activation.spawn_task(self.next)
+
+    def activate(self, activation, **input):
+        if activation.task.status == READY:
+            self.spawn_subprocesses(activation, **input)
 
         if activation.task.status == REENTERING:
             self.reenter(activation)
 
+class Timer(BaseNode):
+    """
+        Wait until a deadline, a timedelta or a function of the activation, 
+        then spawn next.
+    """
+    fanout = (1, 1)
+
+    def __init__(self, deadline, next, **options):
+        super().__init__(**options)
+        self.deadline = deadline
+        self.next = next
+
+    def successors(self):
+        return (self.next,)
+
+    def activate(self, activation, **input):
+        if activation.task.status == READY:
+            activation.task.deadline = get_deadline(self.deadline, activation)
+            activation.stall()
+        
+        elif activation.task.status == EXPIRED:
+            activation.done()
+            activation.spawn_task(self.next)
+
 class UserAction(BaseNode):
-    def __init__(self, form_class, next, **options):
+    """
+        Wait for the submission of a form.
+
+        Once the deadline passed, the escalate hook is called with the 
+        activation, the task then waits again unless the hook moved it on.
+    """
+    fanout = (1, 1)
+
+    def __init__(self, form_class, next, deadline=None, escalate=None, **options):
         super().__init__(**options)
         self.form_class = form_class
         self.next = next
+        self.deadline = deadline
+        self.escalate = escalate
+
+    def successors(self):
+        return (self.next,)
 
-    def submit(self, activation, **kwargs):
+    def validate(self, task, context, **kwargs):
+        """
+            Returns the validated form of a submission
+        """
         # Cannot submit if the task is not in a stall state.
-        if activation.task.status != STALL:
+        if task.status != STALL:
             raise exceptions.TaskNotStall()
 
         form_kwargs = kwargs['form_kwargs']
 
         form = self.form_class(
             **form_kwargs,
-            instance=activation.context
+            instance=context
         )
 
-        form.task = activation.task
+        form.task = task
 
-        if form.is_valid():
-            activation.context = form.save()
-            activation.submitted()        
-        else:
+        if not form.is_valid():
             raise exceptions.InvalidForm(form)
+        
+        return form
+
+    def submit(self, activation, form=None, **kwargs):
+        if activation.task.status != STALL:
+            raise exceptions.TaskNotStall()
+
+        if form is None:
+            form = self.validate(activation.task, activation.context, **kwargs)
+
+        activation.context = form.save()
+        activation.submitted()        
 
     def activate(self, activation, **input):
         if activation.task.status == READY:
             activation.task.status = STALL
+
+            if self.deadline is not None:
+                activation.task.deadline = get_deadline(self.deadline, activation)
         
         elif activation.task.status == SUBMITTED:
             activation.done()
             activation.spawn_task(self.next)     
 
+        elif activation.task.status == EXPIRED:
+            activation.task.deadline = None
+
+            if self.escalate:
+                self.escalate(activation, **input)
+            
+            if activation.task.status == EXPIRED:
+                activation.stall()
+
+def get_deadline(deadline, activation):
+    if callable(deadline):
+        deadline = deadline(activation)
+    
+    if isinstance(deadline, timedelta):
+        return timezone.now() + deadline
+    
+    return deadline
+
 class End(BaseNode):
+    terminal = True
+
     def activate(self, activation, **input):
         activation.close_workflow()
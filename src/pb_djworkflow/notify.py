@@ -0,0 +1,51 @@
+import threading, time
+from django.db import transaction
+
+class Notifier:
+    """
+        Wake up the threads waiting for task activations, once they are committed.
+
+        Waiters in other processes are not notified, they check back 
+        with an increasing interval.
+    """
+    def __init__(self, interval=0.05, max_interval=1.0):
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.interval = interval
+        self.max_interval = max_interval
+
+    def notify(self):
+        with self.condition:
+            self.generation += 1
+            self.condition.notify_all()
+
+    def notify_on_commit(self):
+        transaction.on_commit(self.notify)
+
+    def wait(self, predicate, timeout=None):
+        """
+            Wait until the predicate holds, returns False on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        interval = self.interval
+
+        while True:
+            generation = self.generation
+
+            if predicate():
+                return True
+
+            delay = interval
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+
+            with self.condition:
+                if generation == self.generation:
+                    self.condition.wait(delay)
+            
+            interval = min(interval * 2, self.max_interval)
+
+NOTIFIER = Notifier()
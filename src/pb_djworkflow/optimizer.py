@@ -0,0 +1,95 @@
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch, QuerySet
+from graphene.utils.str_converters import to_snake_case
+from graphql.language.ast import FieldNode, FragmentSpreadNode, InlineFragmentNode
+
+def optimize(queryset, info):
+    """
+        Plan the select_related and prefetch_related of a queryset,
+        from the selection set of the GraphQL field it resolves.
+    """
+    if not isinstance(queryset, QuerySet):
+        queryset = queryset.all()
+
+    selections = []
+
+    for field_node in info.field_nodes:
+        selections.extend(_node_selections(field_node, info.fragments))
+
+    return _apply(queryset, _plan(queryset.model, selections, info.fragments))
+
+def _apply(queryset, plan):
+    select, prefetch = plan
+
+    if select:
+        queryset = queryset.select_related(*select)
+
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+
+    return queryset
+
+def _fields(selection_set, fragments):
+    """
+        Flatten the fields of a selection set, through the fragments.
+    """
+    if selection_set is None:
+        return
+
+    for selection in selection_set.selections:
+        if isinstance(selection, FieldNode):
+            yield selection
+
+        elif isinstance(selection, FragmentSpreadNode):
+            yield from _fields(fragments[selection.name.value].selection_set, fragments)
+
+        elif isinstance(selection, InlineFragmentNode):
+            yield from _fields(selection.selection_set, fragments)
+
+def _node_selections(field_node, fragments):
+    """
+        Returns the selected fields of the objects, under the connection edges if any.
+    """
+    fields = list(_fields(field_node.selection_set, fragments))
+    edges = [field for field in fields if field.name.value == 'edges']
+
+    if not edges:
+        return fields
+
+    return [
+        node_field
+        for edge in edges
+        for node in _fields(edge.selection_set, fragments) if node.name.value == 'node'
+        for node_field in _fields(node.selection_set, fragments)
+    ]
+
+def _plan(model, selections, fragments, prefix=''):
+    select = []
+    prefetch = []
+
+    for selection in selections:
+        try:
+            field = model._meta.get_field(to_snake_case(selection.name.value))
+        except FieldDoesNotExist:
+            continue
+
+        if not field.is_relation:
+            continue
+
+        path = prefix + (field.name if field.concrete else field.get_accessor_name())
+        nested = _node_selections(selection, fragments)
+
+        if field.many_to_one or (field.one_to_one and field.concrete):
+            select.append(path)
+            nested_select, nested_prefetch = _plan(field.related_model, nested, fragments, prefix=path + '__')
+            select.extend(nested_select)
+            prefetch.extend(nested_prefetch)
+
+        else:
+            queryset = _apply(
+                field.related_model._default_manager.all(),
+                _plan(field.related_model, nested, fragments)
+            )
+            prefetch.append(Prefetch(path, queryset=queryset))
+
+    return select, prefetch
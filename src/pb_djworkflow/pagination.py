@@ -0,0 +1,150 @@
+import json
+from base64 import b64decode, b64encode
+from binascii import Error as Base64Error
+from functools import partial
+
+import graphene
+from graphene import relay
+from graphql import GraphQLError
+from graphene_django.filter import DjangoFilterConnectionField
+from graphene_django.utils import maybe_queryset
+from django.db.models import QuerySet
+
+PREFIX = 'keyset:'
+
+def to_cursor(value):
+    return b64encode((PREFIX + json.dumps(value)).encode()).decode()
+
+def from_cursor(cursor):
+    try:
+        decoded = b64decode(cursor.encode()).decode()
+    except (Base64Error, UnicodeDecodeError):
+        raise GraphQLError(f'Invalid cursor "{cursor}"')
+
+    if not decoded.startswith(PREFIX):
+        raise GraphQLError(f'Invalid cursor "{cursor}"')
+
+    try:
+        return json.loads(decoded[len(PREFIX):])
+    except ValueError:
+        raise GraphQLError(f'Invalid cursor "{cursor}"')
+
+class CountableConnection(relay.Connection):
+    """
+        A connection whose total count is only computed when selected.
+    """
+    class Meta:
+        abstract = True
+
+    total_count = graphene.Int()
+
+    def resolve_total_count(self, info):
+        if isinstance(self.iterable, QuerySet):
+            return self.iterable.count()
+
+        return len(self.iterable)
+
+class KeysetConnectionField(DjangoFilterConnectionField):
+    """
+        A connection paged on an ordered, unique key instead of an offset.
+
+        The cursors encode the key of the edge, so a page is a range scan
+        on the key index whatever its depth.
+    """
+    def __init__(self, type_, *args, key='pk', **kwargs):
+        self.key = key
+        super().__init__(type_, *args, **kwargs)
+
+    def wrap_resolve(self, parent_resolver):
+        return partial(
+            self.keyset_resolver,
+            parent_resolver,
+            self.connection_type,
+            self.get_manager(),
+            self.get_queryset_resolver(),
+            self.max_limit,
+            self.key
+        )
+
+    @classmethod
+    def keyset_resolver(cls, resolver, connection, default_manager, queryset_resolver, max_limit, key, root, info, **args):
+        for arg in ('first', 'last'):
+            if max_limit and args.get(arg) is not None and args[arg] > max_limit:
+                raise GraphQLError(
+                    f'Requesting {args[arg]} records on the `{info.field_name}` connection exceeds the `{arg}` limit of {max_limit} records.'
+                )
+
+        iterable = resolver(root, info, **args)
+        if iterable is None:
+            iterable = default_manager
+
+        iterable = maybe_queryset(queryset_resolver(connection, iterable, info, args))
+
+        if args.get('first') is None and args.get('last') is None:
+            args['first'] = max_limit
+
+        return cls.resolve_keyset(connection, iterable, key, args)
+
+    @classmethod
+    def resolve_keyset(cls, connection, iterable, key, args):
+        first, last = args.get('first'), args.get('last')
+        after, before = args.get('after'), args.get('before')
+        offset = args.get('offset') or 0
+
+        if isinstance(iterable, QuerySet) and iterable._result_cache is None:
+            page = iterable.order_by(key)
+
+            if after is not None:
+                page = page.filter(**{f'{key}__gt': from_cursor(after)})
+
+            if before is not None:
+                page = page.filter(**{f'{key}__lt': from_cursor(before)})
+
+            if last is not None and first is None:
+                # Scanned backwards from the end of the range.
+                rows = list(page.reverse()[offset:offset + last + 1])[::-1]
+            else:
+                rows = list(page[offset:offset + first + 1] if first is not None else page[offset:])
+
+        else:
+            # Already loaded, prefetched by the parent.
+            rows = sorted(iterable, key=lambda obj: _key(obj, key))
+
+            if after is not None:
+                rows = [obj for obj in rows if _key(obj, key) > from_cursor(after)]
+
+            if before is not None:
+                rows = [obj for obj in rows if _key(obj, key) < from_cursor(before)]
+
+            if last is not None and first is None:
+                rows = rows[max(len(rows) - offset - last - 1, 0):len(rows) - offset]
+            else:
+                rows = rows[offset:offset + first + 1] if first is not None else rows[offset:]
+
+        has_previous, has_next = after is not None or offset > 0, before is not None
+
+        if first is not None and len(rows) > first:
+            rows, has_next = rows[:first], True
+
+        if last is not None:
+            if first is None and len(rows) > last:
+                rows, has_previous = rows[1:], True
+            elif len(rows) > last:
+                rows, has_previous = rows[-last:], True
+
+        edges = [connection.Edge(node=obj, cursor=to_cursor(_key(obj, key))) for obj in rows]
+
+        instance = connection(
+            edges=edges,
+            page_info=relay.PageInfo(
+                start_cursor=edges[0].cursor if edges else None,
+                end_cursor=edges[-1].cursor if edges else None,
+                has_previous_page=has_previous,
+                has_next_page=has_next,
+            )
+        )
+        instance.iterable = iterable
+        return instance
+
+def _key(obj, key):
+    return obj.pk if key == 'pk' else getattr(obj, key)
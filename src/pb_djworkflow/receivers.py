@@ -1,15 +1,65 @@
-from . import signals, tasks, status
+from . import signals, status, inbox
 from .engine import ENGINE
-from .models import Task
+from .tracing import TRACER
+from .models import Task, JoinCounter
 
+from django.contrib.auth.models import User
+from django.db.models.signals import m2m_changed, pre_delete
 from django.dispatch import receiver
 
 @receiver(signals.closed_workflow)
 def reenter_on_closure_supratasks(sender, process, **kwargs):
-    for task in Task.objects.filter(subprocess=process):
-        tasks.reenter(task.id)
+    ENGINE.reenter(*Task.objects.select_related('process').filter(subprocess=process, status=status.STALL))
         
 @receiver(signals.failed_workflow)
 def reenter_on_failure_supratasks(sender, process, **kwargs):
-    for task in Task.objects.filter(subprocess=process):
-        tasks.reenter(task.id)
\ No newline at end of file
+    ENGINE.reenter(*Task.objects.select_related('process').filter(subprocess=process, status=status.STALL))
+
+@receiver(signals.closed_workflow)
+def join_on_closure_map_supratask(sender, process, **kwargs):
+    if process.supratask_id is None:
+        return
+
+    supratask = Task.objects.select_related('process').filter(id=process.supratask_id, status=status.STALL).first()
+
+    # Only the last closed subprocess reenters.
+    if supratask is not None and JoinCounter.arrive(supratask.process_id, supratask.step):
+        ENGINE.reenter(supratask)
+
+@receiver(signals.failed_workflow)
+def reenter_on_failure_map_supratask(sender, process, **kwargs):
+    if process.supratask_id is not None:
+        ENGINE.reenter(*Task.objects.select_related('process').filter(id=process.supratask_id, status=status.STALL))
+
+@receiver(signals.closed_workflow)
+def trace_closed_workflow(sender, process, **kwargs):
+    TRACER.end_process(process)
+
+@receiver(signals.failed_workflow)
+def trace_failed_workflow(sender, process, **kwargs):
+    TRACER.end_process(process, error='failed')
+
+@receiver(m2m_changed, sender=User.groups.through)
+def sync_inbox_on_membership(sender, instance, action, reverse, pk_set, **kwargs):
+    """
+        Sync the inboxes of the group tasks, when the members of a group change.
+    """
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    
+    if reverse:
+        opened = Task.objects.filter(assigned_to_group=instance, status=status.STALL)
+    elif action == 'post_clear':
+        opened = Task.objects.filter(inbox_entries__user=instance)
+    else:
+        opened = Task.objects.filter(assigned_to_group__in=pk_set, status=status.STALL)
+    
+    inbox.sync(*opened)
+
+@receiver(pre_delete, sender=Task)
+def close_inbox_on_deletion(sender, instance, **kwargs):
+    """
+        Update the counts of the assignees of a deleted task, 
+        before its inbox entries are deleted by cascade.
+    """
+    inbox.close([instance.id])
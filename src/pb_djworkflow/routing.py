@@ -0,0 +1,78 @@
+import threading, time
+from collections import namedtuple
+
+from celery.utils.time import rate
+from kombu.utils.limits import TokenBucket
+
+class Route(namedtuple('Route', ['queue', 'priority', 'rate_limit', 'partitions'])):
+    """
+        Where and how the activations of a node are sent, the options
+        of the node override the ones of its flow.
+
+        queue: the Celery queue, the default one if None
+        priority: the priority of the messages, if the broker supports it
+        rate_limit: the activations of the node per worker process, as "10/s"
+        partitions: spread the processes over as many queues, by process id
+    """
+    @classmethod
+    def of(cls, flow, node):
+        return cls(*(
+            getattr(flow, field) if getattr(node, field) is None else getattr(node, field)
+            for field in cls._fields
+        ))
+
+    def queue_of(self, process_id, default):
+        """
+            Returns the queue of the activations of a process.
+        """
+        if not self.partitions:
+            return self.queue or default
+
+        # The activations of a process are consumed by the same workers.
+        return '{}.{}'.format(self.queue or default, process_id % self.partitions)
+
+    def options(self, process_id, default):
+        """
+            Returns the options of an activation message.
+        """
+        options = {}
+
+        # Otherwise left to the routes of Celery.
+        if self.queue is not None or self.partitions:
+            options['queue'] = self.queue_of(process_id, default)
+
+        if self.priority is not None:
+            options['priority'] = self.priority
+
+        return options
+
+class RateLimiter:
+    """
+        Token buckets by node, shared by the activations of a worker process.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def wait(self, key, rate_limit):
+        """
+            Block until the rate limit allows one more activation.
+        """
+        fill_rate = rate(rate_limit)
+
+        if not fill_rate:
+            return
+
+        while True:
+            with self.lock:
+                bucket = self.buckets.get(key)
+
+                if bucket is None or bucket.fill_rate != fill_rate:
+                    bucket = self.buckets[key] = TokenBucket(fill_rate, capacity=1)
+
+                if bucket.can_consume(1):
+                    return
+
+                delay = bucket.expected_time(1)
+
+            time.sleep(delay)
@@ -1,67 +1,204 @@
 import graphene
-from graphene import ObjectType, Field, Mutation, relay, String, Boolean
+from graphene import ObjectType, InputObjectType, Field, relay, String, Boolean, List, NonNull
 from graphene_django.types import ErrorType
-from graphene_django.forms.mutation import DjangoModelFormMutation
+from graphene_django.forms.mutation import DjangoModelFormMutation, fields_for_form
 from graphene_django.constants import MUTATION_ERRORS_FLAG
 from graphene_django import DjangoObjectType
-from graphene_django.filter import DjangoFilterConnectionField
+from graphene_django.registry import get_global_registry
 from graphene_django.forms.mutation import DjangoModelFormMutation
 from graphql_relay import from_global_id, to_global_id
 
 from pb_graphene import GlobalID, PlusDjangoModelFormMutation
 
 import django.db.models
-from django.db.models import Q
+from django.db.models import F
 from django.forms import Form
 
 from . import tasks
 from . import models
 from . import nodes
 from . import exceptions
+from . import optimizer
+from .pagination import KeysetConnectionField, CountableConnection
 
-class User(DjangoObjectType):
+class OptimizedDjangoObjectType(DjangoObjectType):
+    """
+        Plans the related objects to load from the selection set. 
+        
+        The relations are plain fields, read from the loaded objects.
+    """
+    class Meta:
+        abstract = True
+
+    @classmethod
+    def get_queryset(cls, queryset, info):
+        return optimizer.optimize(queryset, info)
+
+class PrefetchedConnectionField(KeysetConnectionField):
+    """
+        A connection over a relation, read from the prefetched objects when not filtered.
+    """
+    @classmethod
+    def resolve_queryset(cls, connection, iterable, info, args, filtering_args, filterset_class):
+        if getattr(iterable, '_result_cache', None) is not None and not any(
+            args.get(arg) is not None for arg in filtering_args
+        ):
+            return iterable
+        
+        return super().resolve_queryset(connection, iterable, info, args, filtering_args, filterset_class)
+
+class User(OptimizedDjangoObjectType):
     class Meta:
         model = models.User
         filter_fields = ('id', 'username', 'email')
         interfaces = (relay.Node,)
+        connection_class = CountableConnection
 
-class Group(DjangoObjectType):
+class Group(OptimizedDjangoObjectType):
     class Meta:
         model = models.Group
         filter_fields = ('id',)
         interfaces = (relay.Node,)
+        connection_class = CountableConnection
 
-class Task(DjangoObjectType):
+class Task(OptimizedDjangoObjectType):
     class Meta:
         model = models.Task
         filter_fields = ('id', 'status', 'process')
         interfaces = (relay.Node,)
+        connection_class = CountableConnection
     
     assigned_to_user = Field(User)
     assigned_to_group = Field(Group)
+    done_by = Field(User)
+    process = Field(lambda: Process)
+    subprocess = Field(lambda: Process)
+    previous = Field(lambda: Task)
+    followings = PrefetchedConnectionField(lambda: Task)
+
+    def resolve_followings(root, info, **kwargs):
+        return root.followings.all()
         
-class MyTask(DjangoObjectType):
+class MyTask(Task):
+    """
+        The tasks of the inbox of the user, with the fields of Task.
+    """
     class Meta:
         model = models.Task
         interfaces = (relay.Node, )
+        connection_class = CountableConnection
         filter_fields = ('id', 'status', 'process')
 
-class Process(DjangoObjectType):
+class Process(OptimizedDjangoObjectType):
     class Meta:
         model = models.Process
         filter_fields = ('status',)
         interfaces = (relay.Node,)
+        connection_class = CountableConnection
+
+    created_by = Field(User)
+    tasks = PrefetchedConnectionField(Task)
+    supratasks = PrefetchedConnectionField(Task)
+
+    def resolve_tasks(root, info, **kwargs):
+        return root.tasks.all()
+    
+    def resolve_supratasks(root, info, **kwargs):
+        return root.supratasks.all()
+
+class MutationRegistry:
+    """
+        The generated mutations, built on first access and cached per flow and per node.
+    """
+    def __init__(self):
+        self.context_types = {}
+        self.mutations = {}
+        self.roots = {}
+    
+    def register_context_type(self, flow, context_type):
+        self.context_types[flow] = context_type
+
+    def context_type(self, flow):
+        if flow not in self.context_types:
+            context_type = get_global_registry().get_type_for_model(flow.context_class)
+
+            if context_type is None:
+                context_type = type(
+                    flow.context_class.__name__, 
+                    (DjangoObjectType,), 
+                    {'Meta': type('Meta', (), {'model': flow.context_class, 'fields': '__all__'})}
+                )
+            
+            self.context_types[flow] = context_type
+        
+        return self.context_types[flow]
+
+    def create_mutation(self, flow, context_type):
+        return self._cached((flow, 'create', context_type), _gen_create_flow_mutation, flow, context_type)
+
+    def task_mutation(self, flow, node, context_type):
+        return self._cached((flow, node.name, context_type), _gen_create_task_mutation, flow, node, context_type)
+    
+    def bulk_task_mutation(self, flow, node, context_type):
+        return self._cached(
+            (flow, 'bulk_' + node.name, context_type), 
+            _gen_bulk_task_mutation, flow, node, context_type, self.task_mutation(flow, node, context_type)
+        )
+
+    def fields(self, flow, context_type=None):
+        """
+            The mutation fields of a flow, by field name.
+        """
+        context_type = context_type or self.context_type(flow)
+        fields = {'create': self.create_mutation(flow, context_type).Field()}
+
+        for node in flow.graph.nodes:
+            if isinstance(node, nodes.UserAction):
+                field = self.task_mutation(flow, node, context_type)
+                fields[field.name] = field.Field()
+                
+                bulk_field = self.bulk_task_mutation(flow, node, context_type)
+                fields[bulk_field.name] = bulk_field.Field()
+
+        return fields
+
+    def root(self, flows=None):
+        """
+            A mutation root over the flows, the registered ones by default.
+
+            The fields are prefixed by the name of their flow.
+        """
+        if flows is None:
+            from .engine import ENGINE
+            flows = ENGINE.flows.values()
+
+        key = tuple(sorted(flows, key=lambda flow: flow.get_name()))
+        
+        if key not in self.roots:
+            fields = {
+                "{}_{}".format(flow.get_name(), name): field
+                for flow in key
+                for name, field in self.fields(flow).items()
+            }
+            self.roots[key] = type("WorkflowMutation", (ObjectType,), fields)
+        
+        return self.roots[key]
+
+    def _cached(self, key, gen, *args):
+        if key not in self.mutations:
+            self.mutations[key] = gen(*args)
+        
+        return self.mutations[key]
+
+MUTATIONS = MutationRegistry()
 
 def generate_flow_mutation(flow, context_type, **fields):
+    MUTATIONS.register_context_type(flow, context_type)
+
     fields = {
         **fields,
-        'create': _gen_create_flow_mutation(flow, context_type).Field()
+        **MUTATIONS.fields(flow, context_type)
     }
-    
-    for step, node in flow.steps.items():
-        if isinstance(node, nodes.UserAction):
-            field = _gen_create_task_mutation(flow, node, context_type)
-            fields[field.name] = field.Field()
 
     return type("{}Mutations".format(flow.__name__), (ObjectType,), fields)
 
@@ -111,7 +248,7 @@ def _gen_create_flow_mutation(flow, context_type):
     else:
         class CreateFlow(graphene.Mutation):
             class Meta:
-                name = "Create{}".format(flow.name.capitalize())
+                name = "Create{}".format(flow.get_name().capitalize())
 
             ok = Boolean()
             process = Field(Process)
@@ -148,7 +285,7 @@ def _gen_create_task_mutation(flow, node, context_type):
             
         class Meta:
             form_class = node.form_class
-            name = "{}{}".format(type_name.capitalize(), flow.name.capitalize())
+            name = "{}{}".format(type_name.capitalize(), flow.get_name().capitalize())
        
         @classmethod
         def mutate_and_get_payload(cls, root, info, **data):
@@ -179,22 +316,105 @@ def _gen_create_task_mutation(flow, node, context_type):
 
     return TaskMutation
 
+def _gen_bulk_task_mutation(flow, node, context_type, task_mutation):
+    type_name = "{}{}".format(node.name.capitalize(), flow.get_name().capitalize())
+
+    submission = type(
+        "Bulk{}Input".format(type_name), 
+        (InputObjectType,), 
+        {
+            'task': GlobalID(required=True),
+            **fields_for_form(node.form_class(), (), ())
+        }
+    )
+
+    class BulkTaskResult(ObjectType):
+        class Meta:
+            name = "Bulk{}Result".format(type_name)
+
+        task = Field(Task)
+        context = Field(context_type)
+        ok = Boolean()
+        errors = List(ErrorType)
+
+    class BulkTaskMutation(graphene.Mutation):
+        name = "bulk_{}".format(node.name)
+        
+        class Meta:
+            name = "Bulk{}".format(type_name)
+        
+        class Arguments:
+            submissions = List(NonNull(submission), required=True)
+
+        results = List(BulkTaskResult)
+
+        @classmethod
+        def mutate(cls, root, info, submissions):
+            task_ids = []
+            form_kwargs_per_task = []
+
+            for data in submissions:
+                data = dict(data)
+                task_ids.append(from_global_id(data.pop('task'))[1])
+                form_kwargs_per_task.append(task_mutation.get_form_kwargs(root, info, **data))
+            
+            kwargs = {}
+
+            if getattr(info.context, 'user'):
+                kwargs['user'] = info.context.user
+
+            results = []
+
+            for result in tasks.submit_many(task_ids, form_kwargs_per_task, **kwargs):
+                if result.error is None:
+                    results.append(BulkTaskResult(task=result.task, context=result.activation.context, ok=True, errors=[]))
+                
+                elif isinstance(result.error, exceptions.TaskNotStall):
+                    results.append(BulkTaskResult(task=result.task, ok=False, errors=[ErrorType(field='task', messages=['Task is not stall'])]))
+                
+                elif isinstance(result.error, exceptions.InvalidForm):
+                    _set_errors_flag_to_context(info)
+                    results.append(BulkTaskResult(task=result.task, ok=False, errors=ErrorType.from_errors(result.error.form.errors)))
+                
+                elif isinstance(result.error, models.Task.DoesNotExist):
+                    results.append(BulkTaskResult(task=None, ok=False, errors=[ErrorType(field='task', messages=['Task does not exist'])]))
+                
+                else:
+                    results.append(BulkTaskResult(task=result.task, ok=False, errors=[ErrorType(field='task', messages=[str(result.error)])]))
+
+            return cls(results=results)
+
+    return BulkTaskMutation
+
 class Query(ObjectType):
-    processes = DjangoFilterConnectionField(Process)
-    tasks = DjangoFilterConnectionField(Task)
-    my_tasks = DjangoFilterConnectionField(MyTask)
+    processes = KeysetConnectionField(Process)
+    tasks = KeysetConnectionField(Task)
+    my_tasks = KeysetConnectionField(MyTask, key='inbox_position')
+    my_tasks_count = graphene.Int()
     process = relay.Node.Field(Process)
     task = relay.Node.Field(Task)
 
-    def resolve_my_tasks(self, info):
+    def resolve_my_tasks(self, info, **kwargs):
+        # Paged on the inbox of the user, in the order the tasks opened.
+        position = F('inbox_entries__id')
+
         if info.context.user.is_anonymous:
-            return Task.objects.none()
+            return models.Task.objects.annotate(inbox_position=position).none()
         else:
-            return Task.objects.filter(
-                Q(assigned_to_user=info.context.user) 
-                | 
-                Q(assigned_to_group__user=info.context.user)
-            )
-
-class Mutation(ObjectType):
-    pass
\ No newline at end of file
+            return models.Task.objects\
+                .filter(inbox_entries__user=info.context.user)\
+                .annotate(inbox_position=position)
+
+    def resolve_my_tasks_count(self, info):
+        if info.context.user.is_anonymous:
+            return 0
+        
+        counter = models.InboxCounter.objects.filter(user=info.context.user).first()
+        return counter.count if counter else 0
+
+def __getattr__(name):
+    # The mutation root of the registered flows, built on first access.
+    if name == 'Mutation':
+        return MUTATIONS.root()
+    
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
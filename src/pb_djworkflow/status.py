@@ -7,3 +7,12 @@ ABORTED = 'aborted'
 FAILED  = 'failed'
 SUBMITTED = 'submitted'
 REENTERING = 'reentering'
+# The deadline of a stalled task passed, see Engine.fire_deadlines
+EXPIRED = 'expired'
+
+# A task in one of these states waits for no activation.
+QUIESCENT = (STALL, CLOSED, FAILED, ABORTED)
+# A task in one of these states will never be activated again.
+FINAL = (CLOSED, FAILED, ABORTED)
+# A task in one of these states waits for an activation.
+PENDING = (INIT, READY, SUBMITTED, REENTERING, EXPIRED)
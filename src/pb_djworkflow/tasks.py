@@ -1,39 +1,127 @@
 from celery import shared_task
 from celery.utils.log import get_task_logger
-from .status import REENTERING
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from .status import STALL, REENTERING, PENDING
+from .exceptions import StaleActivation
 
 logger = get_task_logger(__name__)
 
-@shared_task
-def activate(task_id, **options):
+@shared_task(bind=True, ignore_result=True)
+def activate(self, task_id, **options):
     from .engine import ENGINE
     from .models import Task
 
     logger.debug("Activating task {}".format(str(task_id)))
-    task = Task.objects.get(id=int(task_id))
-    act = ENGINE.activate(task, **options)
+    task = Task.objects.select_related('process').filter(id=int(task_id)).first()
+
+    # Rolled back, redelivered once activated, or dispatched again since.
+    if task is None or task.status not in PENDING or task.current_job not in (None, self.request.id):
+        logger.debug("Skipping the stale activation {} of task {}".format(self.request.id, str(task_id)))
+        return None
+
+    # A job running for longer than the sweep delay is considered lost.
+    if not ENGINE.running(task):
+        logger.debug("Task {} was activated concurrently".format(str(task_id)))
+        return None
+
+    task.traceparent = _header(self.request, 'traceparent')
+    ENGINE.throttle(task)
+    
+    try:
+        act = ENGINE.activate(task, **options)
+    except StaleActivation:
+        logger.debug("Task {} was activated concurrently".format(str(task_id)))
+        return None
     
     return act.to_edge().to_json()
 
-@shared_task
-def reenter(task_id, **options):
+@shared_task(bind=True, ignore_result=True)
+def reenter(self, task_id, **options):
     """
-        Reenter a supratask, executed when the subprocess closes or fails
+        Reenter a supratask, executed when the subprocess closes or fails.
+
+        The supratask is claimed out of its stall, a duplicated reentry is a no-op.
     """
     from .engine import ENGINE
     from .models import Task
+    from . import inbox
 
-    logger.debug("Activating task {}".format(str(task_id)))
-    task = Task.objects.get(id=int(task_id))
-    task.status = REENTERING
-    act = ENGINE.activate(task, **options)
+    logger.debug("Reentering task {}".format(str(task_id)))
+
+    with transaction.atomic():
+        claimed = Task.objects.filter(id=int(task_id), status=STALL).update(
+            status=REENTERING, 
+            version=F('version') + 1,
+            started_at=timezone.now()
+        )
+
+        if claimed:
+            # No more stalled, out of the inbox of its assignees.
+            inbox.close([int(task_id)])
+
+    if not claimed:
+        logger.debug("Task {} is not waiting for a reentry".format(str(task_id)))
+        return None
+
+    task = Task.objects.select_related('process').get(id=int(task_id))
+    task.traceparent = _header(self.request, 'traceparent')
+
+    try:
+        act = ENGINE.activate(task, **options)
+    except StaleActivation:
+        logger.debug("Task {} was activated concurrently".format(str(task_id)))
+        return None
     
     return act.to_edge().to_json()
 
+@shared_task(ignore_result=True)
+def fire_deadlines(limit=500):
+    """
+        Activate a batch of the expired tasks, run periodically by celery beat.
+
+        A full batch schedules the next one at once, to drain a backlog.
+    """
+    from .engine import ENGINE
+
+    fired = ENGINE.fire_deadlines(limit=limit)
+    logger.debug("Fired {} deadlines".format(fired))
+
+    if fired == limit:
+        fire_deadlines.delay(limit=limit)
+    
+    return fired
+
+@shared_task(ignore_result=True)
+def sweep_tasks(older_than=600, chunk_size=500):
+    """
+        Redispatch the stuck tasks, run periodically by celery beat.
+    """
+    from datetime import timedelta
+    from .engine import ENGINE
+
+    stats = ENGINE.sweep(older_than=timedelta(seconds=older_than), chunk_size=chunk_size)
+    logger.info("Swept tasks: {}".format(stats))
+
+    return stats
+
+def _header(request, name):
+    # Merged into the request by the workers, kept apart when eager.
+    return request.get(name) or (request.headers or {}).get(name)
+
 def submit(task, **kwargs):
     from .engine import ENGINE
     return ENGINE.submit(task, **kwargs)
 
+def submit_many(tasks, form_kwargs_per_task, **kwargs):
+    from .engine import ENGINE
+    return ENGINE.submit_many(tasks, form_kwargs_per_task, **kwargs)
+
 def spawn_flow(flow, **kwargs):
     from .engine import ENGINE
-    return ENGINE.spawn_flow(flow, **kwargs)
\ No newline at end of file
+    return ENGINE.spawn_flow(flow, **kwargs)
+
+def spawn_flows(flow, kwargs_list, **kwargs):
+    from .engine import ENGINE
+    return ENGINE.spawn_flows(flow, kwargs_list, **kwargs)
\ No newline at end of file
@@ -0,0 +1,231 @@
+import json, os, threading, time, uuid
+from contextlib import contextmanager
+
+# The tracing of a process is rooted at a span derived from its id.
+NAMESPACE = uuid.UUID('8f0e1f4c-5a0b-4b55-9d56-6c1c4a3c2f7e')
+
+class SpanContext:
+    def __init__(self, trace_id, span_id):
+        self.trace_id = trace_id
+        self.span_id = span_id
+
+    @classmethod
+    def of_process(cls, process_id):
+        """
+            Returns the context of the root span of a process.
+        """
+        return cls(
+            uuid.uuid5(NAMESPACE, f'trace:{process_id}').hex,
+            uuid.uuid5(NAMESPACE, f'span:{process_id}').hex[:16]
+        )
+
+    @classmethod
+    def from_traceparent(cls, traceparent):
+        """
+            Parse a W3C traceparent header, returns None if malformed.
+        """
+        try:
+            version, trace_id, span_id, flags = traceparent.split('-')
+        except (AttributeError, ValueError):
+            return None
+
+        if len(trace_id) != 32 or len(span_id) != 16:
+            return None
+
+        return cls(trace_id, span_id)
+
+    def to_traceparent(self):
+        return f'00-{self.trace_id}-{self.span_id}-01'
+
+class Span:
+    def __init__(self, name, parent, context=None, start=None, attributes=None):
+        self.name = name
+        self.parent = parent
+        self.context = context or SpanContext(parent.trace_id, uuid.uuid4().hex[:16])
+        self.start = start or time.time_ns()
+        self.end = None
+        self.attributes = dict(attributes or {})
+        self.events = []
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def add_event(self, name, **attributes):
+        self.events.append((name, time.time_ns(), attributes))
+
+    def to_json(self):
+        return {
+            'traceId': self.context.trace_id,
+            'spanId': self.context.span_id,
+            'parentSpanId': self.parent.span_id if self.parent else '',
+            'name': self.name,
+            # Internal
+            'kind': 1,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': _attributes(self.attributes),
+            'events': [
+                {'timeUnixNano': str(at), 'name': name, 'attributes': _attributes(attributes)}
+                for name, at, attributes in self.events
+            ],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1},
+        }
+
+class JsonFileExporter:
+    """
+        Append the spans to a file, as OTLP/JSON lines, one per export.
+
+        The format is the one of the file exporter of the OpenTelemetry collector.
+    """
+    def __init__(self, path, service_name='pb_djworkflow'):
+        self.path = path
+        self.service_name = service_name
+        self.lock = threading.Lock()
+
+    def export(self, spans):
+        line = json.dumps({
+            'resourceSpans': [{
+                'resource': {'attributes': _attributes({'service.name': self.service_name, 'process.pid': os.getpid()})},
+                'scopeSpans': [{
+                    'scope': {'name': 'pb_djworkflow'},
+                    'spans': [span.to_json() for span in spans]
+                }]
+            }]
+        })
+
+        with self.lock, open(self.path, 'a') as file:
+            file.write(line + '\n')
+
+class Tracer:
+    """
+        Traces the lifecycle of the processes, a no-op without exporter.
+    """
+    def __init__(self, exporter=None):
+        self.exporter = exporter
+        self.local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.exporter is not None
+
+    def current(self):
+        return getattr(self.local, 'span', None)
+
+    @contextmanager
+    def span(self, name, parent, **attributes):
+        """
+            Open a span, current within the block, and export it once closed.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        span = Span(name, parent, attributes=attributes)
+        previous, self.local.span = self.current(), span
+
+        try:
+            yield span
+        except Exception as e:
+            span.error = str(e)
+            raise
+        finally:
+            self.local.span = previous
+            span.end = time.time_ns()
+            self.exporter.export([span])
+
+    def traceparent(self, task):
+        """
+            Returns the header propagating the trace to the activation of a task.
+        """
+        if not self.enabled:
+            return None
+
+        parent = getattr(task, 'traceparent', None)
+
+        if parent is None:
+            current = self.current()
+            parent = (current.context if current else SpanContext.of_process(task.process_id)).to_traceparent()
+
+        return parent
+
+    def parent(self, task):
+        """
+            Returns the parent of the activation span of a task.
+        """
+        return SpanContext.from_traceparent(getattr(task, 'traceparent', None)) \
+            or SpanContext.of_process(task.process_id)
+
+    @contextmanager
+    def activation(self, task, flow, profile):
+        """
+            Open the span of a task activation, under the span that spawned the task.
+        """
+        if not self.enabled:
+            yield None
+            return
+
+        with self.span(
+            f'activate {task.step}', 
+            self.parent(task),
+            **{
+                'workflow.flow': flow.get_name(),
+                'workflow.step': task.step,
+                'workflow.task_id': task.id,
+                'workflow.process_id': task.process_id,
+                'celery.task_id': task.current_job or '',
+            }
+        ) as span:
+            span.add_event('status', to=task.status)
+
+            try:
+                yield span
+            finally:
+                span.set('workflow.status', task.status)
+                span.set('db.query_count', profile.queries)
+
+    def add_event(self, name, **attributes):
+        span = self.current()
+
+        if span is not None:
+            span.add_event(name, **attributes)
+
+    def end_process(self, process, error=None):
+        """
+            Export the root span of a process, from its creation to now.
+        """
+        if not self.enabled:
+            return
+
+        context = SpanContext.of_process(process.id)
+        span = Span(
+            f'process {process.flow_class}',
+            None,
+            context=context,
+            start=int(process.created_at.timestamp() * 1e9),
+            attributes={
+                'workflow.flow': process.flow_class,
+                'workflow.process_id': process.id,
+                'workflow.status': process.status,
+            }
+        )
+        span.end = time.time_ns()
+        span.error = error
+        self.exporter.export([span])
+
+def _attributes(attributes):
+    return [{'key': key, 'value': _value(value)} for key, value in attributes.items()]
+
+def _value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+
+    if isinstance(value, float):
+        return {'doubleValue': value}
+
+    return {'stringValue': str(value)}
+
+TRACER = Tracer()
@@ -0,0 +1,74 @@
+import copy
+from django.db.models import DEFERRED
+
+class DirtyFieldsMixin:
+    """
+        Tracks the fields changed since the model was loaded or saved.
+
+        A save only writes the changed columns, and is skipped if none changed.
+    """
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance.mark_clean()
+        return instance
+
+    def refresh_from_db(self, *args, **kwargs):
+        super().refresh_from_db(*args, **kwargs)
+        self.mark_clean(kwargs.get('fields') or (args[1] if len(args) > 1 else None))
+
+    def mark_clean(self, fields=None):
+        """
+            Set the fields, all the loaded ones by default, as written.
+        """
+        if fields is None or getattr(self, '_saved_state', None) is None:
+            self._saved_state = {}
+
+        for field in self._meta.concrete_fields:
+            if fields is not None and field.name not in fields and field.attname not in fields:
+                continue
+
+            value = self.__dict__.get(field.attname, DEFERRED)
+
+            if value is not DEFERRED:
+                self._saved_state[field.attname] = _copy(value)
+
+    def get_dirty_fields(self):
+        """
+            Returns the names of the fields changed since the last load or save,
+            or None if the state of the model is unknown.
+        """
+        saved_state = getattr(self, '_saved_state', None)
+
+        if saved_state is None or self._state.adding:
+            return None
+
+        return [
+            field.name
+            for field in self._meta.concrete_fields
+            if not field.primary_key
+            and field.attname in self.__dict__
+            and (field.attname not in saved_state or saved_state[field.attname] != self.__dict__[field.attname])
+        ]
+
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+
+        if update_fields is None and not args and not kwargs.get('force_insert'):
+            dirty_fields = self.get_dirty_fields()
+
+            if dirty_fields is not None:
+                if not dirty_fields:
+                    return
+
+                kwargs['update_fields'] = dirty_fields
+
+        super().save(*args, **kwargs)
+        self.mark_clean(None if update_fields is None else update_fields)
+
+def _copy(value):
+    # Mutable values, such as json ones, may change in place.
+    if isinstance(value, (dict, list)):
+        return copy.deepcopy(value)
+
+    return value
@@ -0,0 +1,43 @@
+from pb_djworkflow.flows import Workflow, WorkflowMeta
+from pb_djworkflow import nodes
+
+from ..models import SimpleContext
+
+# The number of routes of the wide branch.
+WIDTH = 16
+
+def noop(activation, **kwargs):
+    pass
+
+def route(index):
+    def predicate(activation, **kwargs):
+        return activation.task.process_id % WIDTH == index
+    
+    return predicate
+
+class LinearFlow(Workflow):
+    name = 'bench_linear'
+    context_class = SimpleContext
+
+    start = nodes.Branch('job_1')
+    job_1 = nodes.Job(noop, next='job_2')
+    job_2 = nodes.Job(noop, next='job_3')
+    job_3 = nodes.Job(noop, next='job_4')
+    job_4 = nodes.Job(noop, next='job_5')
+    job_5 = nodes.Job(noop, next='end')
+
+# A branch testing every route in turn, the processes are spread over the routes.
+WideBranchFlow = WorkflowMeta('WideBranchFlow', (Workflow,), {
+    '__module__': __name__,
+    'name': 'bench_wide_branch',
+    'context_class': SimpleContext,
+    'start': nodes.Branch('route_0', **{f'route_{index}': route(index) for index in range(1, WIDTH)}),
+    **{f'route_{index}': nodes.Job(noop, next='end') for index in range(WIDTH)}
+})
+
+class NestedFlow(Workflow):
+    name = 'bench_nested'
+    context_class = SimpleContext
+
+    start = nodes.Branch('linear')
+    linear = nodes.Subprocess(LinearFlow, lambda activation: {}, noop, next='end')
@@ -0,0 +1,36 @@
+import json, time
+from unittest import skipUnless
+
+from django import test
+
+from pb_djworkflow.engine import ENGINE
+from pb_djworkflow.schema import MutationRegistry
+
+from .test_throughput import BENCHMARK
+
+@skipUnless(BENCHMARK, 'set PB_WORKFLOW_BENCHMARK=1 to run the benchmarks')
+class StartupBenchmark(test.SimpleTestCase):
+    """
+        The cost of the mutation root of the registered flows, built on
+        first access at a cold start, then once cached.
+    """
+    def testMutationRoot(self):
+        registry = MutationRegistry()
+
+        start = time.perf_counter()
+        root = registry.root()
+        cold = time.perf_counter() - start
+
+        start = time.perf_counter()
+        self.assertIs(registry.root(), root)
+        cached = time.perf_counter() - start
+
+        print('\n' + json.dumps({
+            'mutation_root': {
+                'flows': len(ENGINE.flows),
+                'cold_ms': cold * 1000,
+                'cached_ms': cached * 1000,
+            }
+        }, indent=2))
+
+        self.assertLess(cached, cold)
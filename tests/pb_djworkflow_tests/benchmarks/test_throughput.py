@@ -0,0 +1,162 @@
+import json, os, time
+from unittest import skipUnless
+
+from celery.signals import before_task_publish
+
+from pb_djworkflow.models import Process, Task
+from pb_djworkflow.tasks import activate, spawn_flows, submit_many
+from pb_djworkflow.metrics import METRICS
+from pb_djworkflow.notify import NOTIFIER
+from pb_djworkflow.status import STALL
+from pb_djworkflow import metrics
+
+from ..case import WorkflowTestCase
+from ..flows import SimpleFlow
+from .flows import LinearFlow, WideBranchFlow, NestedFlow
+
+# 1 to run the benchmarks against the baselines, update to save new baselines.
+BENCHMARK = os.environ.get('PB_WORKFLOW_BENCHMARK')
+PROCESSES = int(os.environ.get('PB_WORKFLOW_BENCHMARK_PROCESSES', 50))
+TIMEOUT = 120
+
+BASELINES = os.path.join(os.path.dirname(__file__), 'baselines.json')
+# Allowed growth of the query and message counts, over the baselines.
+TOLERANCE = 0.1
+
+MODES = ('eager', 'worker')
+
+def percentile(values, q):
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+@skipUnless(BENCHMARK, 'set PB_WORKFLOW_BENCHMARK=1 to run the benchmarks')
+class ThroughputBenchmark(WorkflowTestCase):
+    """
+        Spawn processes of representative flows, under Celery eager mode
+        and under a local worker, and compare them to the baselines.
+    """
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.reports = {}
+
+        if BENCHMARK != 'update' and os.path.exists(BASELINES):
+            with open(BASELINES) as file:
+                cls.baselines = json.load(file)
+        else:
+            cls.baselines = {}
+
+    @classmethod
+    def tearDownClass(cls):
+        print('\n' + json.dumps(cls.reports, indent=2))
+
+        if BENCHMARK == 'update':
+            with open(BASELINES, 'w') as file:
+                json.dump(cls.reports, file, indent=2, sort_keys=True)
+
+        super().tearDownClass()
+
+    def testLinear(self):
+        self.benchmark('linear', lambda: self.spawn(LinearFlow))
+
+    def testWideBranch(self):
+        self.benchmark('wide_branch', lambda: self.spawn(WideBranchFlow))
+
+    def testNested(self):
+        self.benchmark('nested', lambda: self.spawn(NestedFlow))
+
+    def testUserAction(self):
+        def run():
+            ids = self.spawn(SimpleFlow, form_kwargs={'data': {}}, wait=False)
+            user_actions = Task.objects.filter(process__in=ids, step='to_approve')
+
+            self.wait(lambda: user_actions.filter(status=STALL).count() == len(ids))
+            submit_many(list(user_actions), [{'data': {'approval_decision': True}}] * len(ids))
+            self.wait(lambda: not Process.objects.filter(id__in=ids).exclude(status='done').exists())
+
+            return ids
+
+        self.benchmark('user_action', run)
+
+    def spawn(self, flow, wait=True, **kwargs):
+        ids = [spawn.process.id for spawn in spawn_flows(flow, [kwargs] * PROCESSES)]
+
+        if wait:
+            self.wait(lambda: not Process.objects.filter(id__in=ids).exclude(status='done').exists())
+
+        return ids
+
+    def wait(self, predicate):
+        assert NOTIFIER.wait(predicate, timeout=TIMEOUT), 'the benchmark timed out'
+
+    def benchmark(self, scenario, run):
+        for mode in MODES:
+            with self.subTest(mode=mode):
+                key = f'{scenario}.{mode}'
+                report = self.reports[key] = self.measure(run, eager=(mode == 'eager'))
+                baseline = self.baselines.get(key)
+
+                if baseline is None:
+                    continue
+
+                for measure in ('queries_per_activation', 'messages_per_process'):
+                    assert report[measure] <= baseline[measure] * (1 + TOLERANCE) + 1e-9, \
+                        f'{key}: {measure} regressed from {baseline[measure]} to {report[measure]}'
+
+    def measure(self, run, eager):
+        published = []
+
+        def count(**kwargs):
+            published.append(kwargs['headers']['id'])
+
+        conf = activate.app.conf
+        always_eager, conf.task_always_eager = conf.task_always_eager, eager
+        before_task_publish.connect(count, weak=False)
+
+        first = Process.objects.order_by('-id').values_list('id', flat=True).first() or 0
+        METRICS.reset()
+
+        try:
+            start = time.perf_counter()
+            ids = run()
+            elapsed = time.perf_counter() - start
+        finally:
+            before_task_publish.disconnect(count)
+            conf.task_always_eager = always_eager
+
+        # The subprocesses included.
+        tasks = Task.objects.filter(process__id__gt=first)
+        steps = {}
+
+        for step, dispatched_at, started_at, finished_at in tasks.values_list('step', 'dispatched_at', 'started_at', 'finished_at'):
+            latencies = steps.setdefault(step, {'run': [], 'queue': []})
+            latencies['run'].append((finished_at - started_at).total_seconds())
+
+            if dispatched_at is not None:
+                latencies['queue'].append((started_at - dispatched_at).total_seconds())
+
+        queries = [
+            histogram for (flow, step, metric), histogram in METRICS.histograms.items()
+            if metric == metrics.QUERIES
+        ]
+        activations = sum(histogram.count for histogram in queries)
+
+        return {
+            'processes': len(ids),
+            'seconds': elapsed,
+            'processes_per_second': len(ids) / elapsed,
+            'queries_per_activation': sum(histogram.sum for histogram in queries) / activations,
+            'messages_per_process': len(published) / len(ids),
+            'steps': {
+                step: {
+                    'p50': percentile(latencies['run'], 0.5),
+                    'p99': percentile(latencies['run'], 0.99),
+                    'queue_p50': percentile(latencies['queue'], 0.5),
+                    'queue_p99': percentile(latencies['queue'], 0.99),
+                }
+                for step, latencies in sorted(steps.items())
+            }
+        }
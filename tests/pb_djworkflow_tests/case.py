@@ -1,9 +1,16 @@
+import threading
+from contextlib import contextmanager
 from django import test
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from celery.result import AsyncResult
 from celery.contrib.testing.worker import start_worker
+from celery.signals import before_task_publish
 from .celery import app
 
+TRANSACTION_STATEMENTS = ('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE SAVEPOINT')
+
 class WorkflowTestCase(test.TransactionTestCase):
     class Meta:
         abstract=True
@@ -24,3 +31,43 @@ class WorkflowTestCase(test.TransactionTestCase):
     def tearDownClass(cls):
         super().tearDownClass()
         cls.celery_worker.__exit__(None, None, None)
+
+    @contextmanager
+    def assertBudget(self, queries, publishes=0):
+        """
+            Fail if the block runs more SQL statements, or publishes more 
+            messages to the broker, than budgeted.
+
+            Only the statements and the messages of the test thread are counted,
+            not the ones of the worker.
+        """
+        thread = threading.get_ident()
+        published = []
+
+        def count(sender=None, **kwargs):
+            if threading.get_ident() == thread:
+                published.append(sender)
+
+        before_task_publish.connect(count, weak=False)
+
+        try:
+            with CaptureQueriesContext(connection) as captured:
+                yield
+        finally:
+            before_task_publish.disconnect(count)
+        
+        # The transaction statements are only captured on some backends.
+        statements = [
+            query['sql'] for query in captured 
+            if not query['sql'].startswith(TRANSACTION_STATEMENTS)
+        ]
+
+        if len(statements) > queries:
+            self.fail("{} queries executed, {} budgeted\n{}".format(
+                len(statements), 
+                queries,
+                "\n".join("{}. {}".format(i, sql) for i, sql in enumerate(statements, start=1))
+            ))
+
+        if len(published) > publishes:
+            self.fail("{} messages published, {} budgeted: {}".format(len(published), publishes, ", ".join(published)))
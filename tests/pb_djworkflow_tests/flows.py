@@ -1,8 +1,11 @@
+from datetime import timedelta
+from django.contrib.auth.models import User
+
 from pb_djworkflow.flows import Workflow, Self, FormBasedContextFactory
 from pb_djworkflow import nodes
 
 from .models import SimpleContext
-from .forms import SimpleForm, CreateForm
+from .forms import SimpleForm, CreateForm, ApproveForm
 
 class SimpleFlow(Workflow):
     name = 'simple'
@@ -27,4 +30,118 @@ class SimpleFlow(Workflow):
     @staticmethod
     def fn_reject(activation, **kwargs):
         activation.context.approved = False
-        activation.context.save()
\ No newline at end of file
+        activation.context.save()
+
+class InlineFlow(Workflow):
+    name = 'inline'
+    inline = True
+    context_class = SimpleContext
+    context_factory = FormBasedContextFactory(CreateForm)
+
+    start = nodes.Branch('to_approve')
+    to_approve = nodes.UserAction(SimpleForm, next='check_approval')
+    check_approval = nodes.Branch('reject', approve=SimpleFlow.fn_check_approve)
+    approve = nodes.Job(SimpleFlow.fn_approve, next='end')
+    reject = nodes.Job(SimpleFlow.fn_reject, next='end')
+class SubprocessFlow(Workflow):
+    name = 'subprocess'
+    context_class = SimpleContext
+
+    start = nodes.Branch('approval')
+    approval = nodes.Subprocess(
+        SimpleFlow, 
+        lambda activation: {'form_kwargs': {'data': {}}}, 
+        lambda activation: None, 
+        next='end'
+    )
+
+class ApprovedFlow(Workflow):
+    name = 'approved'
+    context_class = SimpleContext
+
+    start = nodes.Job(SimpleFlow.fn_approve, next='end')
+
+class SplitFlow(Workflow):
+    name = 'split'
+    context_class = SimpleContext
+
+    start = nodes.Split('approve', reject=lambda activation: False, check=lambda activation: True)
+    approve = nodes.Job(SimpleFlow.fn_approve, next='join')
+    reject = nodes.Job(SimpleFlow.fn_reject, next='join')
+    check = nodes.Branch('join')
+    # The reject branch is never taken.
+    join = nodes.Join(next='end', wait=2)
+
+class ParallelFlow(Workflow):
+    name = 'parallel'
+    context_class = SimpleContext
+
+    start = nodes.Split('to_decide', to_approve=lambda activation: True)
+    to_decide = nodes.UserAction(SimpleForm, next='join')
+    to_approve = nodes.UserAction(ApproveForm, next='join')
+    join = nodes.Join(next='end', wait=2)
+
+class MapFlow(Workflow):
+    name = 'map'
+    context_class = SimpleContext
+
+    start = nodes.MapSubprocess(
+        ApprovedFlow, 
+        lambda activation: range(3), 
+        lambda activation, item: {}, 
+        Self.fn_result, 
+        next='end'
+    )
+
+    @staticmethod
+    def fn_result(activation, subprocesses):
+        activation.context.approved = all(
+            context.approved for context in SimpleContext.objects.filter(process__in=subprocesses)
+        )
+
+class DeadlineFlow(Workflow):
+    name = 'deadline'
+    context_class = SimpleContext
+
+    start = nodes.Timer(timedelta(0), next='to_approve')
+    to_approve = nodes.UserAction(SimpleForm, next='end', deadline=timedelta(0), escalate=Self.fn_escalate)
+
+    @staticmethod
+    def fn_escalate(activation, **kwargs):
+        activation.task.assigned_to_user = User.objects.get(username='manager')
+
+class RoutedFlow(Workflow):
+    name = 'routed'
+    context_class = SimpleContext
+    queue = 'batch'
+    priority = 3
+
+    start = nodes.Branch('crunch')
+    # Never consumed by the test worker
+    crunch = nodes.Job(SimpleFlow.fn_approve, next='end', queue='cpu', rate_limit='10/s', partitions=4)
+
+class FailingFlow(Workflow):
+    name = 'failing'
+    context_class = SimpleContext
+
+    start = nodes.Job(SimpleFlow.fn_approve, next='end', leave=Self.fn_fail)
+
+    @staticmethod
+    def fn_fail(activation, **kwargs):
+        raise ValueError('failed on leave')
+
+class ApprovedContextFactory:
+    """
+        A context factory without build_many.
+    """
+    requires_form_submission = False
+
+    def __call__(self, context_class, process, **kwargs):
+        return context_class.objects.create(process=process, approved=True)
+
+class FactoryFlow(Workflow):
+    name = 'factory'
+    context_class = SimpleContext
+    context_factory = ApprovedContextFactory()
+
+    start = nodes.Branch('end')
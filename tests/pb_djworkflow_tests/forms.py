@@ -11,3 +11,8 @@ class SimpleForm(forms.ModelForm):
     class Meta:
         model = models.SimpleContext
         fields = ['approval_decision']
+
+class ApproveForm(forms.ModelForm):
+    class Meta:
+        model = models.SimpleContext
+        fields = ['approved']
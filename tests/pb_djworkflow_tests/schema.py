@@ -1,6 +1,6 @@
 from graphene import ObjectType, Mutation, Schema
 from graphene_django import DjangoObjectType
-from pb_djworkflow.schema import generate_flow_mutation
+from pb_djworkflow.schema import generate_flow_mutation, Query as WorkflowQuery
 
 from . import flows
 from . import models
@@ -14,7 +14,7 @@ SimpleFlowMutations = generate_flow_mutation(
     SimpleContext
 )
 
-class Query(ObjectType):
+class Query(WorkflowQuery):
     pass
 
 class Mutation(SimpleFlowMutations):
@@ -0,0 +1,145 @@
+from django.utils import timezone
+
+from pb_djworkflow.engine import ENGINE
+from pb_djworkflow.models import Process, Task, JoinCounter
+from pb_djworkflow.tasks import spawn_flow, submit, activate, reenter
+from pb_djworkflow.notify import NOTIFIER
+from pb_djworkflow.status import STALL, PENDING
+
+from .case import WorkflowTestCase
+from .flows import SimpleFlow, SubprocessFlow, SplitFlow, MapFlow, ApprovedFlow, DeadlineFlow
+from .models import SimpleContext
+
+class BudgetTestCase(WorkflowTestCase):
+    """
+        The SQL statements and the broker messages of the activation of each node type.
+
+        The activations run in the test thread, their successors in the worker.
+        An activation job first stamps its start, see Engine.running.
+    """
+    def setUp(self):
+        self.process = self.spawn_process(SimpleFlow)
+    
+    def tearDown(self):
+        # Let the worker settle the successors.
+        assert NOTIFIER.wait(lambda: not Task.objects.filter(status__in=PENDING).exists(), timeout=10)
+
+    def spawn_process(self, flow, **fields):
+        process = Process.objects.create(flow_class=flow.name, **fields)
+        SimpleContext.objects.create(process=process)
+        return process
+
+    def task(self, step, process=None, **fields):
+        task = ENGINE.new_task(step, process or self.process)
+
+        for field, value in fields.items():
+            setattr(task, field, value)
+        
+        task.save()
+        return task
+
+    def testSpawnFlow(self):
+        with self.assertBudget(queries=3, publishes=1):
+            spawn_flow(SimpleFlow, form_kwargs={'data': {}})
+
+    def testBranch(self):
+        task = self.task('start')
+
+        with self.assertBudget(queries=5, publishes=1):
+            activate.apply(args=[task.id])
+
+    def testJob(self):
+        task = self.task('approve')
+
+        with self.assertBudget(queries=6, publishes=1):
+            activate.apply(args=[task.id])
+
+    def testUserAction(self):
+        task = self.task('to_approve')
+
+        with self.assertBudget(queries=4):
+            activate.apply(args=[task.id])
+
+    def testSubmit(self):
+        task = self.task('to_approve', status=STALL)
+
+        with self.assertBudget(queries=4, publishes=1):
+            submit(task, form_kwargs={'data': {'approval_decision': True}})
+
+    def testEnd(self):
+        task = self.task('end')
+
+        with self.assertBudget(queries=6):
+            activate.apply(args=[task.id])
+
+    def testSubprocessSpawn(self):
+        task = self.task('approval', process=self.spawn_process(SubprocessFlow))
+
+        with self.assertBudget(queries=7, publishes=1):
+            activate.apply(args=[task.id])
+
+    def testSubprocessReenter(self):
+        task = self.task(
+            'approval', 
+            process=self.spawn_process(SubprocessFlow), 
+            status=STALL, 
+            subprocess=self.spawn_process(SimpleFlow, status='done')
+        )
+
+        with self.assertBudget(queries=7, publishes=1):
+            reenter.apply(args=[task.id])
+
+        # Already reentered
+        with self.assertBudget(queries=1):
+            reenter.apply(args=[task.id])
+
+    def testSubprocessClose(self):
+        process = self.spawn_process(SimpleFlow)
+        self.task('approval', process=self.spawn_process(SubprocessFlow), status=STALL, subprocess=process)
+        task = self.task('end', process=process)
+
+        # The supratask is reentered by the worker.
+        with self.assertBudget(queries=6, publishes=1):
+            activate.apply(args=[task.id])
+
+    def testJoin(self):
+        process = self.spawn_process(SplitFlow)
+        first, last = self.task('join', process=process), self.task('join', process=process)
+
+        with self.assertBudget(queries=8):
+            activate.apply(args=[first.id])
+
+        # The last arrival spawns the next step.
+        with self.assertBudget(queries=7, publishes=1):
+            activate.apply(args=[last.id])
+
+    def testMapSpawn(self):
+        task = self.task('start', process=self.spawn_process(MapFlow))
+
+        with self.assertBudget(queries=9, publishes=3):
+            activate.apply(args=[task.id])
+
+    def testMapClose(self):
+        supratask = self.task('start', process=self.spawn_process(MapFlow), status=STALL)
+        JoinCounter.objects.create(process_id=supratask.process_id, step='start', expected=2)
+        first, last = [
+            self.task('end', process=self.spawn_process(ApprovedFlow, supratask=supratask)) 
+            for _ in range(2)
+        ]
+
+        with self.assertBudget(queries=9):
+            activate.apply(args=[first.id])
+
+        # Only the last closed subprocess reenters the supratask.
+        with self.assertBudget(queries=9, publishes=1):
+            activate.apply(args=[last.id])
+
+    def testFireDeadlines(self):
+        process = self.spawn_process(DeadlineFlow)
+
+        for _ in range(3):
+            self.task('start', process=process, status=STALL, deadline=timezone.now())
+
+        # Whatever the number of due tasks, and of their inbox entries
+        with self.assertBudget(queries=4, publishes=3):
+            ENGINE.fire_deadlines()
@@ -1,13 +1,31 @@
+import io, json, os, tempfile, time
+from datetime import timedelta
 from itertools import chain
 from django import test
+from django.db import connection, transaction
+from django.db.models import F
+from django.core.management import call_command
+from django.utils import timezone
+from celery.signals import before_task_publish
+from django.test.utils import CaptureQueriesContext
 
-from pb_djworkflow.models import Process
-from pb_djworkflow.tasks import spawn_flow, activate, submit
+from pb_djworkflow.models import Process, Task, InboxEntry, InboxCounter, JoinCounter
+from django.contrib.auth.models import User, Group
+from pb_djworkflow.tasks import spawn_flow, spawn_flows, activate, submit, submit_many
+from pb_djworkflow.exceptions import TaskNotStall, InvalidFlow, StaleActivation, ActivationTimeout
+from pb_djworkflow.flows import Workflow
+from pb_djworkflow import nodes, signals
+from pb_djworkflow.engine import ENGINE
 from pb_djworkflow.status import STALL, DONE, FAILED, SUBMITTED, CLOSED
 from pb_djworkflow.nodes import ActivationEdge
+from pb_djworkflow.metrics import METRICS
+from pb_djworkflow import metrics
+from pb_djworkflow.tracing import TRACER, JsonFileExporter
+from pb_djworkflow.notify import NOTIFIER
+from pb_djworkflow.routing import Route, RateLimiter
 
 from .case import WorkflowTestCase
-from .flows import SimpleFlow
+from .flows import SimpleFlow, InlineFlow, SubprocessFlow, SplitFlow, ParallelFlow, MapFlow, DeadlineFlow, RoutedFlow, FactoryFlow
 from .models import SimpleContext
 
 
@@ -44,3 +62,559 @@ class SimpleTestCase(WorkflowTestCase):
             .follow('check_approval')\
             .follow('approve')\
             .follow('end')
+
+    def testInline(self):
+        edge = ActivationEdge.from_flow_spawn(
+            spawn_flow(
+                InlineFlow, 
+                form_kwargs={'data': {}}
+            )
+        )
+
+        user_action = edge\
+            .follow('start')\
+            .follow('to_approve')\
+            .until_stall().task
+
+        edge = submit(
+            user_action, 
+            form_kwargs={
+                'data': {
+                    'approval_decision': True
+                }
+            }
+        ).to_edge().until_closed()
+
+        end = edge\
+            .follow('check_approval')\
+            .follow('approve')\
+            .follow('end')
+
+        assert end.task.status == CLOSED, end.task.status
+        assert end.task.process.status == 'done', end.task.process.status
+        assert end.task.process.get_context().approved
+
+        # An option, not a branch
+        branch = nodes.Branch('end', inline=True, approve=SimpleFlow.fn_check_approve)
+        assert branch.inline and branch.successors() == ('approve', 'end')
+
+    def testEdgeFromJson(self):
+        edge = ActivationEdge.from_flow_spawn(
+            spawn_flow(
+                SimpleFlow, 
+                form_kwargs={'data': {}}
+            )
+        ).follow('start')
+
+        with self.assertNumQueries(1):
+            loaded = ActivationEdge.from_json(edge.to_json())
+            assert loaded.task.process.flow_class == 'simple'
+            assert [task.step for task in loaded.nexts] == ['to_approve']
+
+    def testSpawnFlows(self):
+        spawns = spawn_flows(
+            SimpleFlow, 
+            [{'form_kwargs': {'data': {}}} for _ in range(5)],
+            chunk_size=2
+        )
+
+        # Spawned without iterating the result
+        assert Process.objects.filter(flow_class='simple').count() == 5
+        assert len(spawns) == 5
+        assert SimpleContext.objects.filter(process__in=[spawn.process for spawn in spawns]).count() == 5
+
+        for spawn in spawns:
+            edge = ActivationEdge.from_flow_spawn(spawn)\
+                .follow('start')\
+                .follow('to_approve')\
+                .until_stall()
+            
+            assert edge.task.status == STALL, edge.task.status
+
+    def testSpawnFlowsWithFactory(self):
+        spawns = spawn_flows(FactoryFlow, [{} for _ in range(3)])
+        
+        processes = Process.objects.filter(id__in=[spawn.process.id for spawn in spawns])
+        
+        assert SimpleContext.objects.filter(process__in=processes, approved=True).count() == 3
+        assert NOTIFIER.wait(lambda: not processes.exclude(status=DONE).exists(), timeout=10)
+
+    def testSubmitMany(self):
+        user_actions = [
+            ActivationEdge.from_flow_spawn(spawn)\
+                .follow('start')\
+                .follow('to_approve')\
+                .until_stall().task
+            for spawn in spawn_flows(
+                SimpleFlow, 
+                [{'form_kwargs': {'data': {}}} for _ in range(3)]
+            )
+        ]
+
+        submit(user_actions[0], form_kwargs={'data': {'approval_decision': False}})
+
+        results = submit_many(
+            user_actions, 
+            [{'data': {'approval_decision': True}} for _ in user_actions]
+        )
+
+        assert isinstance(results[0].error, TaskNotStall), results[0].error
+
+        with self.assertRaises(ValueError):
+            submit_many(user_actions, [{'data': {'approval_decision': True}}])
+        
+        for result in results[1:]:
+            assert result.error is None, result.error
+            assert result.activation.to_edge()\
+                .follow('check_approval')\
+                .follow('approve')\
+                .follow('end')\
+                .task.process.get_context().approved
+
+    def testSubmitManyOfProcess(self):
+        process = spawn_flow(ParallelFlow).process
+        user_actions = Task.objects.filter(process=process, status=STALL).order_by('step')
+        assert NOTIFIER.wait(lambda: user_actions.count() == 2, timeout=10)
+
+        results = submit_many(
+            list(user_actions), 
+            [{'data': {'approved': True}}, {'data': {'approval_decision': True}}]
+        )
+
+        # Each one against its own context
+        assert [result.error for result in results] == [None, None]
+        assert results[0].activation.context is not results[1].activation.context
+        assert results[1].activation.context.approved
+
+        assert NOTIFIER.wait(lambda: Process.objects.get(pk=process.pk).status == DONE, timeout=10)
+        context = process.get_context()
+        assert context.approved and context.approval_decision
+
+    def testResolve(self):
+        process = Process.objects.create(flow_class='simple')
+        SimpleContext.objects.create(process=process)
+        lost, dispatched = ENGINE.new_task('approve', process), ENGINE.new_task('reject', process)
+        Task.objects.bulk_create([lost, dispatched])
+
+        # Never dispatched
+        with self.assertRaises(ActivationTimeout) as raised:
+            ActivationEdge.resolve([lost], timeout=0.5)
+        
+        assert raised.exception.task is lost
+
+        # Waits for the activation, notified by the worker
+        with transaction.atomic():
+            ENGINE.dispatch(ENGINE.reserve_job(dispatched))
+        
+        edge = ActivationEdge.resolve([dispatched], timeout=10)[0]
+        assert edge.task.status == CLOSED
+        assert [task.step for task in edge.nexts] == ['end']
+
+        edge.follow('end').until_closed()
+
+    def testFlowGraph(self):
+        graph = SimpleFlow.graph
+
+        assert graph.successors[graph.id('check_approval')] == (graph.id('approve'), graph.id('reject'))
+        assert graph.fanouts[graph.id('check_approval')] == (1, 1)
+        assert graph.is_reachable('end')
+        assert graph.can_terminate('start')
+        assert graph.predecessors[graph.id('end')] == (graph.id('approve'), graph.id('reject'))
+
+        with self.assertRaises(InvalidFlow):
+            class BrokenFlow(Workflow):
+                start = nodes.Job(SimpleFlow.fn_approve, next='missing')
+        
+        with self.assertRaisesRegex(InvalidFlow, 'unreachable steps "orphan"'):
+            class UnreachableFlow(Workflow):
+                start = nodes.Job(SimpleFlow.fn_approve, next='end')
+                orphan = nodes.Job(SimpleFlow.fn_approve, next='end')
+        
+        with self.assertRaisesRegex(InvalidFlow, 'no end can be reached'):
+            class EndlessFlow(Workflow):
+                start = nodes.Job(SimpleFlow.fn_approve, next='loop')
+                loop = nodes.Job(SimpleFlow.fn_approve, next='start')
+        
+        with self.assertRaises(InvalidFlow):
+            ENGINE.new_task('missing', Process(flow_class='simple'))
+
+    def testInbox(self):
+        alice = User.objects.create(username='alice')
+        bob = User.objects.create(username='bob')
+        group = Group.objects.create(name='approvers')
+        group.user_set.add(bob)
+
+        user_action = ActivationEdge.from_flow_spawn(
+            spawn_flow(
+                SimpleFlow, 
+                form_kwargs={'data': {}}
+            )
+        ).follow('start').follow('to_approve').until_stall().task
+        
+        user_action.assigned_to_user = alice
+        user_action.assigned_to_group = group
+        user_action.save()
+
+        assert set(InboxEntry.objects.values_list('user__username', flat=True)) == {'alice', 'bob'}
+        assert InboxCounter.objects.get(user=bob).count == 1
+
+        group.user_set.remove(bob)
+        assert InboxCounter.objects.get(user=bob).count == 0
+
+        submit(user_action, form_kwargs={'data': {'approval_decision': True}})
+
+        assert not InboxEntry.objects.exists()
+        assert InboxCounter.objects.get(user=alice).count == 0
+
+        # Deleted with its process
+        user_action = ActivationEdge.from_flow_spawn(
+            spawn_flow(SimpleFlow, form_kwargs={'data': {}})
+        ).follow('start').follow('to_approve').until_stall().task
+        user_action.assigned_to_user = alice
+        user_action.save()
+        assert InboxCounter.objects.get(user=alice).count == 1
+
+        user_action.process.delete()
+        assert not InboxEntry.objects.exists()
+        assert InboxCounter.objects.get(user=alice).count == 0
+
+    def testDirtyFields(self):
+        process = Process.objects.create(flow_class='simple')
+        context = SimpleContext.objects.create(process=process)
+        context = SimpleContext.objects.get(pk=context.pk)
+
+        # Unchanged, not written
+        with self.assertNumQueries(0):
+            context.save()
+        
+        context.approved = True
+
+        with CaptureQueriesContext(connection) as queries:
+            context.save()
+            context.save()
+        
+        assert len(queries) == 1
+        assert 'approval_decision' not in queries[0]['sql']
+        assert not context.get_dirty_fields()
+
+    def testIdentityMap(self):
+        user_action = ActivationEdge.from_flow_spawn(
+            spawn_flow(
+                InlineFlow, 
+                form_kwargs={'data': {}}
+            )
+        ).follow('start').follow('to_approve').until_stall().task
+
+        with CaptureQueriesContext(connection) as queries:
+            submit(user_action, form_kwargs={'data': {'approval_decision': True}})
+        
+        # The inline chain shares the process and the context of the user action.
+        selects = [query['sql'] for query in queries if query['sql'].startswith('SELECT')]
+        assert len([sql for sql in selects if 'FROM "pb_djworkflow_tests_simplecontext"' in sql]) == 1, selects
+        assert not [sql for sql in selects if 'FROM "pb_djworkflow_process"' in sql], selects
+
+    def testMetrics(self):
+        METRICS.reset()
+
+        user_action = ActivationEdge.from_flow_spawn(
+            spawn_flow(
+                SimpleFlow, 
+                form_kwargs={'data': {}}
+            )
+        ).follow('start').follow('to_approve').until_stall().task
+
+        assert user_action.dispatched_at <= user_action.started_at <= user_action.finished_at
+        
+        end = submit(user_action, form_kwargs={'data': {'approval_decision': True}})\
+            .to_edge()\
+            .follow('check_approval')\
+            .follow('approve')\
+            .follow('end')\
+            .until_closed().task
+        
+        assert end.closed_at is not None
+        assert METRICS.get('simple', 'to_approve', metrics.THINK).count == 1
+        
+        for step in ('start', 'to_approve', 'check_approval', 'approve', 'end'):
+            assert METRICS.get('simple', step, metrics.QUEUE_WAIT).count == 1, step
+            assert METRICS.get('simple', step, metrics.QUERIES).sum > 0, step
+        
+        assert METRICS.snapshot()['simple']['to_approve'][metrics.WALL]['count'] == 2
+
+    def testSubprocess(self):
+        approval = ActivationEdge.from_flow_spawn(
+            spawn_flow(SubprocessFlow)
+        ).follow('start').follow('approval').until_stall().task
+
+        clerk = User.objects.create(username='clerk')
+        approval.assigned_to_user = clerk
+        approval.save()
+        assert InboxCounter.objects.get(user=clerk).count == 1
+
+        user_action = ActivationEdge.resolve(
+            [Task.objects.get(process=approval.subprocess, step='start')]
+        )[0].follow('to_approve').until_stall().task
+
+        submit(user_action, form_kwargs={'data': {'approval_decision': True}})
+        
+        # Reentered once the subprocess is closed
+        approval.wait([CLOSED], timeout=10)
+        end = approval.get_edge().follow('end').until_closed().task
+        assert end.process.status == DONE
+
+        # Out of the inbox once reentered
+        assert not InboxEntry.objects.filter(task=approval).exists()
+        assert InboxCounter.objects.get(user=clerk).count == 0
+
+    def testSplitJoin(self):
+        process = spawn_flow(SplitFlow).process
+        assert NOTIFIER.wait(lambda: Process.objects.get(pk=process.pk).status == DONE, timeout=10)
+
+        steps = sorted(Task.objects.filter(process=process).values_list('step', flat=True))
+        assert steps == ['approve', 'check', 'end', 'join', 'join', 'start'], steps
+        assert JoinCounter.objects.get(process=process, step='join').arrived == 2
+
+    def testMapSubprocess(self):
+        process = spawn_flow(MapFlow).process
+        assert NOTIFIER.wait(lambda: Process.objects.get(pk=process.pk).status == DONE, timeout=10)
+
+        start = Task.objects.get(process=process, step='start')
+        assert start.subprocesses.filter(status=DONE).count() == 3
+        assert JoinCounter.objects.get(process=process, step='start').arrived == 3
+        assert process.get_context().approved
+
+    def testFailedActivation(self):
+        process = Process.objects.create(flow_class='failing')
+        SimpleContext.objects.create(process=process)
+        task = ENGINE.new_task('start', process)
+        task.save()
+
+        with self.assertRaises(ValueError):
+            ENGINE.activate(Task.objects.get(pk=task.pk))
+        
+        # Only the failure is written
+        task = Task.objects.get(pk=task.pk)
+        assert task.status == FAILED and task.log == 'failed on leave'
+        assert not task.followings.exists()
+        assert Process.objects.get(pk=process.pk).status == FAILED
+        assert not process.get_context().approved
+
+    def testStaleActivation(self):
+        process = Process.objects.create(flow_class='simple')
+        SimpleContext.objects.create(process=process)
+        task = ENGINE.reserve_job(ENGINE.new_task('approve', process))
+        task.save()
+
+        # Not the job the task was dispatched to
+        assert activate.apply(args=[task.id], task_id='duplicate').get() is None
+        assert Task.objects.get(pk=task.pk).status == 'init'
+
+        first, second = Task.objects.get(pk=task.pk), Task.objects.get(pk=task.pk)
+        ENGINE.activate(first)
+
+        with self.assertRaises(StaleActivation):
+            ENGINE.activate(second)
+        
+        # Only the first one spawned a successor
+        task = Task.objects.get(pk=task.pk)
+        assert task.status == CLOSED and task.version == 1
+        assert task.followings.count() == 1
+
+        # Redelivered once activated
+        assert activate.apply(args=[task.id], task_id=task.current_job).get() is None
+
+    def testStaleFailedActivation(self):
+        process = Process.objects.create(flow_class='failing')
+        SimpleContext.objects.create(process=process)
+        task = ENGINE.new_task('start', process)
+        task.save()
+        failed = []
+
+        def receiver(sender, process, **kwargs):
+            failed.append(process.id)
+
+        # Written meanwhile by another activation
+        stale = Task.objects.get(pk=task.pk)
+        Task.objects.filter(pk=task.pk).update(status=DONE, version=F('version') + 1)
+        signals.failed_workflow.connect(receiver)
+
+        try:
+            with self.assertRaises(StaleActivation):
+                ENGINE.activate(stale)
+        finally:
+            signals.failed_workflow.disconnect(receiver)
+
+        # The failure of the stale duplicate is not written
+        assert failed == []
+        assert Task.objects.get(pk=task.pk).status == DONE
+        assert Process.objects.get(pk=process.pk).status != FAILED
+
+    def testDeadlines(self):
+        manager = User.objects.create(username='manager')
+        timer = ActivationEdge.from_flow_spawn(spawn_flow(DeadlineFlow)).follow('start').until_stall().task
+        
+        assert ENGINE.fire_deadlines() == 1
+        user_action = timer.get_edge().follow('to_approve').until_stall().task
+        assert user_action.deadline is not None and user_action.assigned_to_user is None
+
+        clerk = User.objects.create(username='clerk')
+        user_action.assigned_to_user = clerk
+        user_action.save()
+        assert InboxCounter.objects.get(user=clerk).count == 1
+
+        # Out of the inbox once expired, before its activation
+        with ENGINE.batch():
+            assert ENGINE.fire_deadlines() == 1
+            assert not InboxEntry.objects.filter(task=user_action).exists()
+            assert InboxCounter.objects.get(user=clerk).count == 0
+
+        # Escalated, then waits for the submission
+        user_action.wait([STALL], timeout=10)
+        user_action = Task.objects.get(pk=user_action.pk)
+        
+        assert user_action.assigned_to_user == manager and user_action.deadline is None
+        assert InboxEntry.objects.filter(user=manager, task=user_action).exists()
+        assert ENGINE.fire_deadlines() == 0
+
+    def testRouting(self):
+        graph = RoutedFlow.graph
+        assert graph.route('start') == Route('batch', 3, None, None)
+        assert graph.route('crunch') == Route('cpu', 3, '10/s', 4)
+        assert SimpleFlow.graph.route('start').options(1, 'celery') == {}
+
+        process = Process.objects.create(flow_class='routed')
+        task = ENGINE.reserve_job(ENGINE.new_task('crunch', process))
+        task.save()
+        published = []
+
+        def receiver(routing_key, properties, **kwargs):
+            published.append((routing_key, properties.get('priority')))
+
+        before_task_publish.connect(receiver)
+
+        try:
+            with transaction.atomic():
+                ENGINE.dispatch(task)
+        finally:
+            before_task_publish.disconnect(receiver)
+
+        queue = f'cpu.{process.id % 4}'
+        assert published == [(queue, 3)], published
+
+        # Aggregated by step, then by partition
+        with self.assertNumQueries(2):
+            backlog = ENGINE.backlog()
+        
+        assert backlog[queue]['count'] == 1 and backlog[queue]['oldest'] >= 0
+
+        limiter, start = RateLimiter(), time.monotonic()
+
+        for _ in range(3):
+            limiter.wait(('routed', 'crunch'), '20/s')
+        
+        assert time.monotonic() - start >= 0.09
+
+    def testSweep(self):
+        process = Process.objects.create(flow_class='simple')
+        SimpleContext.objects.create(process=process)
+        lost, recent, running = (
+            ENGINE.new_task('approve', process), 
+            ENGINE.reserve_job(ENGINE.new_task('reject', process)),
+            ENGINE.reserve_job(ENGINE.new_task('reject', process))
+        )
+        Task.objects.bulk_create([lost, recent, running])
+        Task.objects.filter(pk=lost.pk).update(created_at=timezone.now() - timedelta(hours=1))
+        # Dispatched long ago, started by a worker since
+        Task.objects.filter(pk=running.pk).update(dispatched_at=timezone.now() - timedelta(hours=1))
+        assert ENGINE.running(running)
+
+        out = io.StringIO()
+        call_command('sweep_tasks', '--dry-run', stdout=out)
+        assert out.getvalue().startswith('1 stuck, 1 running, 0 redispatched'), out.getvalue()
+
+        stats = ENGINE.sweep(chunk_size=1)
+        assert (stats['stuck'], stats['running'], stats['redispatched']) == (1, 1, 1), stats
+        
+        lost = Task.objects.get(pk=lost.pk)
+        lost.wait([CLOSED], timeout=10)
+        assert Task.objects.get(pk=recent.pk).status == 'init'
+        assert Task.objects.get(pk=running.pk).current_job == running.current_job
+
+    def testFailedWorkflow(self):
+        process = Process.objects.create(flow_class='simple')
+        context = SimpleContext.objects.create(process=process)
+        failed = []
+
+        def receiver(sender, process, **kwargs):
+            failed.append(process.id)
+        
+        signals.failed_workflow.connect(receiver)
+
+        try:
+            # Two branches failing from a stale process
+            for step in ('approve', 'reject'):
+                task = ENGINE.new_task(step, Process.objects.get(pk=process.pk))
+                task.save()
+                nodes.NodeActivation(task, ENGINE, context).fail_workflow()
+        finally:
+            signals.failed_workflow.disconnect(receiver)
+
+        assert failed == [process.id]
+        assert Process.objects.get(pk=process.pk).status == FAILED
+
+    def testTracing(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'traces.json')
+            TRACER.exporter = JsonFileExporter(path)
+
+            try:
+                user_action = ActivationEdge.from_flow_spawn(
+                    spawn_flow(
+                        SimpleFlow, 
+                        form_kwargs={'data': {}}
+                    )
+                ).follow('start').follow('to_approve').until_stall().task
+
+                submit(user_action, form_kwargs={'data': {'approval_decision': True}})\
+                    .to_edge()\
+                    .follow('check_approval')\
+                    .follow('approve')\
+                    .follow('end')\
+                    .until_closed()
+            finally:
+                TRACER.exporter = None
+
+            with open(path) as file:
+                spans = [
+                    span 
+                    for line in file 
+                    for resource in json.loads(line)['resourceSpans'] 
+                    for scope in resource['scopeSpans'] 
+                    for span in scope['spans']
+                ]
+
+        # One trace, rooted at the process.
+        assert len({span['traceId'] for span in spans}) == 1
+        
+        by_id = {span['spanId']: span for span in spans}
+        root, = [span for span in spans if not span['parentSpanId']]
+        assert root['name'] == 'process simple'
+
+        for span in spans:
+            if span is not root:
+                assert span['parentSpanId'] in by_id, span['name']
+        
+        activations = [span['name'] for span in spans if span['name'].startswith('activate')]
+        assert sorted(activations) == sorted([
+            'activate start', 'activate to_approve', 'activate to_approve', 
+            'activate check_approval', 'activate approve', 'activate end'
+        ]), activations
+        
+        # Propagated through the headers of the dispatched activations.
+        end, = [span for span in spans if span['name'] == 'activate end']
+        assert by_id[end['parentSpanId']]['name'] == 'activate approve'
+        assert by_id[by_id[end['parentSpanId']]['parentSpanId']]['name'] == 'activate check_approval'
+        attributes = {attribute['key']: attribute['value'] for attribute in end['attributes']}
+        assert attributes['workflow.status'] == {'stringValue': CLOSED}
+        assert int(attributes['db.query_count']['intValue']) > 0
+        assert attributes['celery.task_id']['stringValue']
@@ -1,19 +1,194 @@
+from base64 import b64encode
 from itertools import chain
+from types import SimpleNamespace
+from unittest import mock
 from django import test
+from django.contrib.auth.models import User
 
-from pb_djworkflow.models import Process
+from pb_djworkflow.models import Process, Task
 from pb_djworkflow.tasks import spawn_flow, activate, submit
-from pb_djworkflow.status import STALL, DONE, FAILED, SUBMITTED, CLOSED
+from pb_djworkflow.status import STALL, DONE, FAILED, CLOSED
 from pb_djworkflow.nodes import ActivationEdge
+from pb_djworkflow.engine import ENGINE
+from pb_djworkflow.notify import NOTIFIER
+from pb_djworkflow.flows import Workflow
+from pb_djworkflow import nodes
+from pb_djworkflow import schema as workflow_schema
+from pb_djworkflow.schema import MUTATIONS, MutationRegistry, Query as WorkflowQuery
 
 from .case import WorkflowTestCase
-from .flows import SimpleFlow
+from .flows import SimpleFlow, InlineFlow
 from .models import SimpleContext
-from .schema import schema
+from .forms import SimpleForm
+from .schema import schema, SimpleContext as SimpleContextType
 
+from graphene import Schema
 from graphene.test import Client
+from graphql_relay import to_global_id
 
 # Create your tests here.
 class SimpleTestCase(WorkflowTestCase):
     def testSchema(self):
         client = Client(schema)
+
+
+class QueryCountTestCase(WorkflowTestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='user')
+
+        for _ in range(5):
+            process = Process.objects.create(flow_class='simple', created_by=self.user)
+            task = Task.objects.create(process=process, step='to_approve', status=STALL, assigned_to_user=self.user)
+            Task.objects.create(process=process, step='approve', status=CLOSED, previous=task)
+
+    def execute(self, query, **variables):
+        result = schema.execute(query, context_value=SimpleNamespace(user=self.user), variable_values=variables)
+        self.assertIsNone(result.errors)
+        return result.data
+
+    def testTasks(self):
+        # The page, with its related objects joined.
+        with self.assertNumQueries(1):
+            data = self.execute('''{ 
+                tasks { edges { node { 
+                    step 
+                    process { id createdBy { username } } 
+                    assignedToUser { username } 
+                    previous { step } 
+                } } } 
+            }''')
+        
+        self.assertEqual(len(data['tasks']['edges']), 10)
+
+    def testProcesses(self):
+        # The page, then the tasks of every process at once.
+        with self.assertNumQueries(2):
+            data = self.execute('''{ 
+                processes { edges { node { 
+                    tasks { edges { node { step assignedToUser { username } } } } 
+                } } } 
+            }''')
+        
+        for edge in data['processes']['edges']:
+            self.assertEqual(len(edge['node']['tasks']['edges']), 2)
+
+    def testMyTasks(self):
+        with self.assertNumQueries(1):
+            data = self.execute('{ myTasks { edges { node { step process { id } } } } }')
+        
+        self.assertEqual(len(data['myTasks']['edges']), 5)
+
+    def testKeysetPages(self):
+        query = '''query ($after: String) {
+            tasks(first: 4, after: $after, status: STALL) { 
+                pageInfo { hasNextPage endCursor } 
+                edges { node { id } } 
+            }
+        }'''
+        seen, after = [], None
+
+        while True:
+            # Seeked from the cursor, without counting the rows.
+            with self.assertNumQueries(1):
+                data = self.execute(query, after=after)['tasks']
+            
+            seen.extend(edge['node']['id'] for edge in data['edges'])
+
+            if not data['pageInfo']['hasNextPage']:
+                break
+
+            after = data['pageInfo']['endCursor']
+        
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(len(set(seen)), 5)
+        
+        data = self.execute('{ tasks(last: 2) { totalCount pageInfo { hasPreviousPage } edges { node { step } } } }')
+        self.assertEqual(data['tasks']['totalCount'], 10)
+        self.assertTrue(data['tasks']['pageInfo']['hasPreviousPage'])
+        self.assertEqual([edge['node']['step'] for edge in data['tasks']['edges']], ['to_approve', 'approve'])
+
+        # A malformed cursor is rejected like any other invalid one.
+        for after in ('not a cursor', b64encode(b'keyset:{').decode()):
+            result = schema.execute(query, context_value=SimpleNamespace(user=self.user), variable_values={'after': after})
+            self.assertEqual(result.errors[0].message, f'Invalid cursor "{after}"')
+
+class BulkMutationTestCase(WorkflowTestCase):
+    def testBulkSubmit(self):
+        user = User.objects.create(username='user')
+        user_actions = [
+            ActivationEdge.from_flow_spawn(spawn_flow(SimpleFlow, form_kwargs={'data': {}}))\
+                .follow('start')\
+                .follow('to_approve')\
+                .until_stall().task
+            for _ in range(2)
+        ]
+        ids = [to_global_id('Task', task.id) for task in user_actions] + [to_global_id('Task', 0)]
+
+        # The form kwargs of pb-graphene 0.0.2 call an undefined helper.
+        task_mutation = MUTATIONS.task_mutation(SimpleFlow, SimpleFlow.to_approve, SimpleContextType)
+        form_kwargs = classmethod(lambda cls, root, info, **data: {'data': data})
+
+        with mock.patch.object(task_mutation, 'get_form_kwargs', form_kwargs):
+            result = schema.execute(
+                '''mutation ($submissions: [BulkTo_approveSimpleInput!]!) {
+                    bulkToApprove(submissions: $submissions) { 
+                        results { ok task { id } errors { field messages } } 
+                    }
+                }''',
+                context_value=SimpleNamespace(user=user),
+                variable_values={'submissions': [{'task': id, 'approvalDecision': True} for id in ids]}
+            )
+
+        self.assertIsNone(result.errors)
+
+        # The missing task is reported with the others
+        results = result.data['bulkToApprove']['results']
+        self.assertEqual([result['ok'] for result in results], [True, True, False])
+        self.assertEqual([result['task'] and result['task']['id'] for result in results], ids[:2] + [None])
+        self.assertEqual(results[2]['errors'], [{'field': 'task', 'messages': ['Task does not exist']}])
+
+        for task in user_actions:
+            self.assertTrue(NOTIFIER.wait(lambda: Process.objects.get(pk=task.process_id).status == DONE, timeout=10))
+
+class MutationRegistryTestCase(test.SimpleTestCase):
+    def testCached(self):
+        registry = MutationRegistry()
+        
+        self.assertIs(
+            registry.task_mutation(SimpleFlow, SimpleFlow.to_approve, SimpleContext),
+            registry.task_mutation(SimpleFlow, SimpleFlow.to_approve, SimpleContext)
+        )
+        self.assertIs(registry.root(), registry.root())
+
+    def testFlowName(self):
+        # Named after its class, without a name
+        class Unnamed(Workflow, abstract=True):
+            context_class = SimpleContext
+            to_approve = nodes.UserAction(SimpleForm, next='end')
+
+        registry = MutationRegistry()
+
+        self.assertEqual(registry.task_mutation(Unnamed, Unnamed.to_approve, SimpleContextType)._meta.name, 'To_approveUnnamed')
+        self.assertEqual(registry.bulk_task_mutation(Unnamed, Unnamed.to_approve, SimpleContextType)._meta.name, 'BulkTo_approveUnnamed')
+
+    def testRoot(self):
+        root = Schema(query=WorkflowQuery, mutation=workflow_schema.Mutation)
+        fields = root.graphql_schema.mutation_type.fields
+
+        for flow in (SimpleFlow, InlineFlow):
+            self.assertIn(f'{flow.name}Create', fields)
+            self.assertIn(f'{flow.name}ToApprove', fields)
+            self.assertIn(f'{flow.name}BulkToApprove', fields)
+
+    def testStartup(self):
+        # Built once at a cold start, then served from the cache.
+        with mock.patch.object(workflow_schema, '_gen_create_task_mutation', wraps=workflow_schema._gen_create_task_mutation) as generate:
+            registry = MutationRegistry()
+            root = registry.root()
+            built = generate.call_count
+
+            self.assertIs(registry.root(), root)
+            self.assertIs(registry.root(ENGINE.flows.values()), root)
+        
+        self.assertEqual(generate.call_count, built)
+        self.assertGreater(built, 0)
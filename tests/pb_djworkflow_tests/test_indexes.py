@@ -0,0 +1,49 @@
+from unittest import skipUnless
+from django import test
+from django.db import connection
+from django.contrib.auth.models import User, Group
+
+from pb_djworkflow.models import Process, Task
+from pb_djworkflow.status import STALL, CLOSED, INIT, PENDING
+
+@skipUnless(connection.vendor == 'sqlite', 'EXPLAIN QUERY PLAN is SQLite specific')
+class IndexesTestCase(test.TestCase):
+    def assertUsesIndex(self, queryset, index):
+        # The parameters are inlined, as psycopg2 does, otherwise SQLite 
+        # cannot match the conditions of the partial indexes.
+        sql, params = queryset.query.sql_with_params()
+        
+        with connection.cursor() as cursor:
+            cursor.execute('EXPLAIN QUERY PLAN ' + connection.ops.last_executed_query(cursor, sql, params))
+            plan = '\n'.join(row[-1] for row in cursor.fetchall())
+        
+        assert index in plan, plan
+
+    def testTaskIndexes(self):
+        user = User.objects.create(username='user')
+        group = Group.objects.create(name='group')
+        process = Process.objects.create(flow_class='simple')
+
+        self.assertUsesIndex(Task.objects.filter(process=process, step='start'), 'pb_task_process_step_idx')
+        self.assertUsesIndex(Task.objects.filter(status=STALL), 'pb_task_status_step_idx')
+        self.assertUsesIndex(Task.objects.filter(assigned_to_user=user, status=STALL), 'pb_task_user_status_idx')
+        self.assertUsesIndex(Task.objects.filter(assigned_to_group=group, status=STALL), 'pb_task_group_status_idx')
+        self.assertUsesIndex(Task.objects.filter(subprocess=process), 'pb_task_subprocess_idx')
+
+    def testPendingIndex(self):
+        process = Process.objects.create(flow_class='simple')
+        
+        # Mostly closed tasks, as in production, for the planner statistics
+        Task.objects.bulk_create(
+            [Task(process=process, step='start', status=CLOSED) for _ in range(500)]
+            + [Task(process=process, step='start', status=INIT) for _ in range(5)]
+        )
+        
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+        self.assertUsesIndex(Task.objects.filter(status__in=PENDING, id__gt=0).order_by('id')[:100], 'pb_task_pending_idx')
+
+    def testProcessIndexes(self):
+        self.assertUsesIndex(Process.objects.filter(flow_class='simple', status='running'), 'pb_process_flow_status_idx')
+        self.assertUsesIndex(Process.objects.filter(status='running'), 'pb_process_status_idx')